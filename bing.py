@@ -0,0 +1,187 @@
+# Client for the Bing DistanceMatrix API for AMC
+
+import time
+import sys
+import threading
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+BING_URL = 'https://dev.virtualearth.net/REST/v1/Routes/DistanceMatrix'
+# Status codes that are worth retrying
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+class BingDistanceMatrix:
+    ''' Driving distances from Bing DistanceMatrix. Many origins are sent in a single
+        request against the same destination (the AMC building) over a pooled session,
+        with timeouts, retries with exponential backoff and a rate limit
+    '''
+    def __init__(self, key, url = BING_URL, max_batch = 625, timeout = 30, retries = 3,
+                 backoff = 1.0, rate_limit = 5, pool_size = 10, session = None):
+        ''' Rate limit is the maximum number of requests per second (None for no limit).
+            Max batch is the maximum number of origins x destinations per request
+        '''
+        self.key = key
+        self.url = url
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.km_mile = 1.60934 #Km per mile
+        self.min_interval = 0 if rate_limit == None else 1.0/rate_limit
+        self._last = 0
+        self._lock = threading.Lock()
+
+        # Pooled session shared by all requests
+        if session == None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        self.session = session
+
+        # Counters
+        self.requests = 0
+        self.failures = 0
+
+    def _wait_rate(self):
+        ''' Block until the next request is allowed by the rate limit '''
+        with self._lock:
+            now = time.monotonic()
+            wait = self._last + self.min_interval - now
+            if wait > 0:
+                time.sleep(wait)
+                now = time.monotonic()
+            self._last = now
+            self.requests += 1
+
+    def _payload(self, origins, destinations):
+        ''' Body of a matrix request, origins and destinations are lists of (lat, lon) '''
+        return {'origins': [{'latitude': float(lat), 'longitude': float(lon)} for lat, lon in origins],
+                'destinations': [{'latitude': float(lat), 'longitude': float(lon)} for lat, lon in destinations],
+                'travelMode': 'driving'}
+
+    def _parse(self, resp, n_origins, n_destinations):
+        ''' Return distance (miles) and duration matrices of a response. Cells without
+            a route are -1
+        '''
+        dist = np.full((n_origins, n_destinations), -1.0)
+        dur = np.full((n_origins, n_destinations), -1.0)
+        results = resp['resourceSets'][0]['resources'][0]['results']
+        for r in results:
+            if r.get('hasError', False) or r.get('travelDistance', -1) < 0:
+                continue
+            i, j = r['originIndex'], r['destinationIndex']
+            dist[i, j] = r['travelDistance']/self.km_mile
+            dur[i, j] = r['travelDuration']
+        return dist, dur
+
+    def request(self, origins, destinations, timeout = None):
+        ''' Send a single matrix request. Returns the distance and duration matrices
+            or None if the request failed after all retries. Timeout (seconds) overrides
+            the timeout of the client for this request
+        '''
+        timeout = self.timeout if timeout == None else timeout
+        body = self._payload(origins, destinations)
+        for attempt in range(self.retries + 1):
+            self._wait_rate()
+            try:
+                response = self.session.post(self.url, params={'key': self.key},
+                                             json=body, timeout=timeout)
+                if response.status_code == 200:
+                    return self._parse(response.json(), len(origins), len(destinations))
+                if response.status_code not in RETRY_STATUS:
+                    break
+                delay = response.headers.get('Retry-After')
+                delay = float(delay) if delay != None else self.backoff*2**attempt
+            except (requests.ConnectionError, requests.Timeout, ValueError, KeyError, IndexError):
+                delay = self.backoff*2**attempt
+            if attempt < self.retries:
+                time.sleep(delay)
+
+        self.failures += 1
+        print('Error when using Bing API', file=sys.stderr)
+        return None
+
+    def to_destination(self, origins, destination):
+        ''' Driving distances from many origins to a single destination. Origins are
+            sent in batches of max_batch. Returns arrays of distance and time (-1 on error)
+        '''
+        n = len(origins)
+        dist = np.full(n, -1.0)
+        dur = np.full(n, -1.0)
+        for start in range(0, n, self.max_batch):
+            batch = origins[start:start + self.max_batch]
+            res = self.request(batch, [destination])
+            if res != None:
+                dist[start:start + len(batch)] = res[0][:, 0]
+                dur[start:start + len(batch)] = res[1][:, 0]
+        return dist, dur
+
+    def resolve(self, pairs):
+        ''' Resolve a dataframe of pending pairs with columns building_code, lat_p, lon_p
+            (origin) and lat, lon (building). Pairs are grouped by building so every
+            request carries many origins. Returns a dataframe with driving_distance and
+            driving_time aligned with the input
+        '''
+        out = pd.DataFrame({'driving_distance': -1.0, 'driving_time': -1.0}, index=pairs.index)
+        for _, grp in pairs.groupby('building_code', sort=False):
+            destination = (grp['lat'].iloc[0], grp['lon'].iloc[0])
+            origins = list(zip(grp['lat_p'], grp['lon_p']))
+            dist, dur = self.to_destination(origins, destination)
+            out.loc[grp.index, 'driving_distance'] = dist
+            out.loc[grp.index, 'driving_time'] = dur
+        return out
+
+    def _batches(self, pairs):
+        ''' Split pending pairs in requests of at most max_batch origins for one building '''
+        batches = []
+        for _, grp in pairs.groupby('building_code', sort=False):
+            destination = (grp['lat'].iloc[0], grp['lon'].iloc[0])
+            for start in range(0, grp.shape[0], self.max_batch):
+                batch = grp.iloc[start:start + self.max_batch]
+                batches.append((batch.index, list(zip(batch['lat_p'], batch['lon_p'])), destination))
+        return batches
+
+    async def resolve_async(self, pairs, max_in_flight = 8, timeout = 120, progress = None):
+        ''' Same as resolve but with up to max_in_flight requests running concurrently.
+            Timeout is given to every HTTP request, so a stalled request fails in its own
+            thread instead of leaving it running (cells stay at -1). Progress
+            is an optional function called with (done, total) after each request
+        '''
+        out = pd.DataFrame({'driving_distance': -1.0, 'driving_time': -1.0}, index=pairs.index)
+        batches = self._batches(pairs)
+        total = len(batches)
+        done = 0
+        loop = asyncio.get_event_loop()
+        sem = asyncio.Semaphore(max_in_flight)
+
+        async def run(executor, origins, destination):
+            nonlocal done
+            async with sem:
+                res = await loop.run_in_executor(executor, self.request, origins, [destination], timeout)
+                done += 1
+                if progress != None:
+                    progress(done, total)
+                return res
+
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            results = await asyncio.gather(*[run(executor, origins, destination) for _, origins, destination in batches])
+
+        # Merge back in input order
+        for (index, _, _), res in zip(batches, results):
+            if res != None:
+                out.loc[index, 'driving_distance'] = res[0][:, 0]
+                out.loc[index, 'driving_time'] = res[1][:, 0]
+        return out
+
+    def resolve_concurrent(self, pairs, max_in_flight = 8, timeout = 120, progress = None):
+        ''' Blocking entry point for resolve_async '''
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.resolve_async(pairs, max_in_flight, timeout, progress))
+        finally:
+            loop.close()
@@ -0,0 +1,110 @@
+# Local stand-in for the Bing DistanceMatrix API for AMC
+#
+# Serves DistanceMatrix requests offline so the driving distance client can be
+# exercised without a key or network. Run as:
+#   python bing_stub.py --port 8765 --fail-rate 0.1 --latency 0.2
+# and point BingDistanceMatrix(url='http://localhost:8765/REST/v1/Routes/DistanceMatrix')
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from geo_amc import haversine_distance
+
+class BingStubHandler(BaseHTTPRequestHandler):
+    ''' Answer DistanceMatrix requests with haversine distances scaled by a road factor '''
+    road_factor = 1.27714323
+    speed_kmm = 1.60934  # Km per minute (60 mph)
+    fail_rate = 0.0
+    latency = 0.0
+    max_cells = 625
+    lock = threading.Lock()
+    counts = {'requests': 0, 'failures': 0, 'cells': 0}
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _matrix(self, origins, destinations):
+        ''' Compute all cells of the matrix '''
+        results = []
+        for i, o in enumerate(origins):
+            for j, d in enumerate(destinations):
+                km = float(haversine_distance(o['latitude'], o['longitude'],
+                                              d['latitude'], d['longitude']))*1.60934*self.road_factor
+                results.append({'originIndex': i, 'destinationIndex': j,
+                                'travelDistance': km, 'travelDuration': km/self.speed_kmm})
+        return {'resourceSets': [{'resources': [{'results': results}]}]}
+
+    def _serve(self, origins, destinations):
+        with self.lock:
+            self.counts['requests'] += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        # Simulate throttling and server errors
+        if random.random() < self.fail_rate:
+            with self.lock:
+                self.counts['failures'] += 1
+            self._reply(random.choice([429, 503]), {'errorDetails': ['Simulated failure']})
+        elif len(origins)*len(destinations) > self.max_cells:
+            self._reply(400, {'errorDetails': ['Too many origins and destinations']})
+        else:
+            with self.lock:
+                self.counts['cells'] += len(origins)*len(destinations)
+            self._reply(200, self._matrix(origins, destinations))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            body = json.loads(self.rfile.read(length))
+            origins, destinations = body['origins'], body['destinations']
+        except (ValueError, KeyError):
+            self._reply(400, {'errorDetails': ['Invalid body']})
+            return
+        self._serve(origins, destinations)
+
+    def do_GET(self):
+        ''' Same format used by the single pair requests: origins=lat,lon;lat,lon '''
+        qs = parse_qs(urlparse(self.path).query)
+        def points(s):
+            return [{'latitude': float(p.split(',')[0]), 'longitude': float(p.split(',')[1])} for p in s.split(';')]
+        try:
+            origins, destinations = points(qs['origins'][0]), points(qs['destinations'][0])
+        except (ValueError, KeyError, IndexError):
+            self._reply(400, {'errorDetails': ['Invalid query']})
+            return
+        self._serve(origins, destinations)
+
+def start_stub(port = 0, fail_rate = 0.0, latency = 0.0):
+    ''' Start the stub server in a background thread. Returns the server and the url
+        to use as DistanceMatrix endpoint. Stop it with server.shutdown()
+    '''
+    handler = type('Handler', (BingStubHandler,), {'fail_rate': fail_rate, 'latency': latency,
+                                                   'counts': {'requests': 0, 'failures': 0, 'cells': 0}})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/REST/v1/Routes/DistanceMatrix'
+    return server, url
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local Bing DistanceMatrix stand-in')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--fail-rate', type=float, default=0.0)
+    parser.add_argument('--latency', type=float, default=0.0)
+    args = parser.parse_args()
+    BingStubHandler.fail_rate = args.fail_rate
+    BingStubHandler.latency = args.latency
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), BingStubHandler)
+    print(f'Serving DistanceMatrix stub on http://127.0.0.1:{args.port}/REST/v1/Routes/DistanceMatrix')
+    server.serve_forever()
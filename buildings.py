@@ -0,0 +1,36 @@
+# AMC building records
+
+from collections import namedtuple
+
+# Fields of amc_buildings in GeoOperations
+BUILDING_FIELDS = ['building_code','name','lat','lon','gd_na','dd_na','dt_na','gd_ia','dd_ia','dt_ia','na','ia']
+
+# One record per building with coordinates and airport fallbacks
+Building = namedtuple('Building', BUILDING_FIELDS)
+
+class BuildingStore:
+    ''' AMC buildings keyed by building code. Lookups return the stored record, so
+        they do not allocate, and join adds building columns to whole dataframes
+    '''
+    def __init__(self, df):
+        ''' Build the store from the amc_buildings dataframe '''
+        df = df[BUILDING_FIELDS].drop_duplicates('building_code')
+        self.records = {row[0]: Building(*row) for row in df.itertuples(index=False, name=None)}
+        self.frame = df.set_index('building_code')
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, building_code):
+        return building_code in self.records
+
+    def get(self, building_code):
+        ''' Return the record of a building or None if not found '''
+        return self.records.get(building_code)
+
+    def join(self, df, columns = None, on = 'building_code'):
+        ''' Return df with the building columns (all by default) added for the
+            building code in column on. Rows of unknown buildings get NaN
+        '''
+        right = self.frame if columns == None else self.frame[columns]
+        return df.join(right, on=on)
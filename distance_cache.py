@@ -0,0 +1,87 @@
+# Cache of the distance lookup table for AMC
+
+from collections import OrderedDict
+import sqlalchemy as db
+
+class DistanceCache:
+    ''' Bounded LRU cache over the distance_lookup table. Pairs (building_code, zipcode)
+        can be loaded in bulk with a single query, the database is only queried for
+        pairs that are not in memory. Pairs not found in the database are cached as well
+    '''
+    def __init__(self, engine, table, maxsize = 100000):
+        ''' Engine is the sqlalchemy engine and table the distance_lookup table definition '''
+        self.engine = engine
+        self.table = table
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _store(self, key, rows):
+        ''' Store rows for key and evict least recently used entries '''
+        self.cache[key] = rows
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+            self.evictions += 1
+
+    def preload(self, pairs):
+        ''' Load all pairs (building_code, zipcode) given in a single query. Returns
+            the number of rows loaded from the database
+        '''
+        pairs = set((b, z) for b, z in pairs if b != None and z != None)
+        if len(pairs) == 0:
+            return 0
+        buildings = sorted(set(b for b, _ in pairs))
+        zips = sorted(set(z for _, z in pairs))
+
+        s = self.table.select().where(db.and_(self.table.c.building_code.in_(buildings),
+                                              self.table.c.zipcode.in_(zips)))
+        with self.engine.connect() as conn:
+            result = [tuple(r) for r in conn.execute(s)]
+
+        # Group rows by pair, pairs requested but not found are stored empty. The query
+        # returns every building x zip combination, rows of pairs not requested are dropped
+        # so they don't evict the requested ones
+        found = {key: [] for key in pairs}
+        loaded = 0
+        for r in result:
+            if (r[0], r[1]) in found:
+                found[(r[0], r[1])].append(r)
+                loaded += 1
+        for key, rows in found.items():
+            self._store(key, rows)
+
+        return loaded
+
+    def get(self, building_code, zipcode):
+        ''' Return the list of rows in distance_lookup for the pair. Uses the database
+            only when the pair is not cached
+        '''
+        key = (building_code, zipcode)
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        self.misses += 1
+        s = self.table.select().where(db.and_(self.table.c.building_code == building_code,
+                                              self.table.c.zipcode == zipcode))
+        with self.engine.connect() as conn:
+            rows = [tuple(r) for r in conn.execute(s)]
+        self._store(key, rows)
+
+        return rows
+
+    def clear(self):
+        ''' Drop all cached pairs, used when the distance_lookup table is updated '''
+        self.cache.clear()
+
+    def stats(self):
+        ''' Return the counters of the cache '''
+        return {'size': len(self.cache),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
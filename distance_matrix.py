@@ -0,0 +1,101 @@
+# Precomputed distance matrix of US zip codes and AMC buildings
+#
+# Offline build step. Computes geodesic distance, driving distance and driving time
+# from every zip code in the US zip file to every AMC building and stores them in a
+# NumPy file that is memory mapped by the workers. Build it with:
+#   python distance_matrix.py <dbstring> [--out distance_matrix] [--model drv_model.json]
+
+import argparse
+import sys
+import numpy as np
+
+# Layers of the matrix
+GEO, DRV, TIME = 0, 1, 2
+
+def build_distance_matrix(zip_table, buildings, path, estimator, lookup = None):
+    ''' Compute the matrix for all zips in zip_table and all buildings (dataframe with
+        building_code, lat and lon) and write it to path.npy (data) and path_index.npz
+        (zips and building codes). Driving distances are estimated with the
+        DrivingEstimator, -1 above its cutoff. Rows of the distance lookup table (dataframe
+        with building_code, zipcode, geodesic_distance, driving_distance, driving_time)
+        replace the estimates where present
+    '''
+    from geo_amc import batch_distance
+
+    bldg_codes = np.asarray(buildings['building_code'].values, dtype=str)
+    n_zip, n_bldg = len(zip_table), bldg_codes.shape[0]
+    data = np.lib.format.open_memmap(path + '.npy', mode='w+', dtype=np.float32, shape=(3, n_zip, n_bldg))
+
+    # One column per building computed over all zips at once
+    for j, (blat, blon) in enumerate(zip(buildings['lat'].astype(float), buildings['lon'].astype(float))):
+        geo = batch_distance(zip_table.lat, zip_table.lon, blat, blon)
+        drv, tm = estimator.predict(geo, [bldg_codes[j]]*n_zip, zip_table.state)
+        data[GEO, :, j] = geo
+        data[DRV, :, j] = np.where(geo >= 0, drv, -1)
+        data[TIME, :, j] = np.where(geo >= 0, tm, -1)
+
+    # Overlay known distances
+    n_known = 0
+    if lookup is not None and lookup.shape[0] > 0:
+        cols = {c: j for j, c in enumerate(bldg_codes)}
+        rows = zip_table.index_zips(lookup['zipcode'].values)
+        bcol = np.array([cols.get(b, -1) for b in lookup['building_code']])
+        ok = (rows != -1) & (bcol != -1)
+        data[GEO, rows[ok], bcol[ok]] = lookup['geodesic_distance'].values[ok]
+        data[DRV, rows[ok], bcol[ok]] = lookup['driving_distance'].values[ok]
+        data[TIME, rows[ok], bcol[ok]] = lookup['driving_time'].values[ok]
+        n_known = int(ok.sum())
+
+    data.flush()
+    np.savez(path + '_index.npz', zips=zip_table.zips, buildings=bldg_codes)
+    return n_known
+
+class DistanceMatrix:
+    ''' Read only view of a precomputed distance matrix. The data is memory mapped, so
+        all processes that load the same file share its pages through the OS cache
+    '''
+    def __init__(self, path):
+        ''' Load path.npy and path_index.npz created by build_distance_matrix '''
+        self.data = np.load(path + '.npy', mmap_mode='r')
+        index = np.load(path + '_index.npz')
+        self.zips = index['zips']
+        self.buildings = {str(b): j for j, b in enumerate(index['buildings'])}
+
+    def lookup(self, zipc, building_code):
+        ''' Return (geodesic, driving distance, driving time) for a zip and a building or
+            None if the pair is not in the matrix
+        '''
+        j = self.buildings.get(building_code, -1)
+        if j == -1:
+            return None
+        try:
+            zipc = int(zipc)
+        except (TypeError, ValueError):
+            return None
+        i = int(np.searchsorted(self.zips, zipc))
+        if i >= self.zips.shape[0] or self.zips[i] != zipc:
+            return None
+        geo, drv, tm = (float(x) for x in self.data[:, i, j])
+        if np.isnan(geo):
+            return None
+        return (geo, drv, tm)
+
+if __name__ == '__main__':
+    import pandas as pd
+    from geo_amc import GeoOperations
+
+    parser = argparse.ArgumentParser(description='Build the zip x building distance matrix')
+    parser.add_argument('dbstring')
+    parser.add_argument('--zipfile', default='us-zip-code-latitude-and-longitude.csv')
+    parser.add_argument('--out', default='distance_matrix')
+    parser.add_argument('--model', default=None, help='Driving estimator fitted with drv_estimator.py')
+    args = parser.parse_args()
+
+    geo = GeoOperations(uszipfile=args.zipfile, key='', dbstring=args.dbstring, drv_model=args.model)
+    try:
+        lookup = pd.read_sql("SELECT building_code, zipcode, geodesic_distance, driving_distance, driving_time FROM distance_lookup WHERE country_code = 'US'", geo.pgsql)
+    except:
+        print('Error: Could not read distance lookup table, using estimates only', file=sys.stderr)
+        lookup = None
+    n = build_distance_matrix(geo.zip_table, geo.amc_buildings, args.out, geo.drv_estimator, lookup=lookup)
+    print(f'Distance matrix {len(geo.zip_table)} x {geo.amc_buildings.shape[0]} written to {args.out}.npy ({n} known pairs)')
@@ -0,0 +1,109 @@
+# Driving distance estimation for AMC
+#
+# Fits ratios between driving and geodesic distance from the distance lookup table
+# rows that have real (API) driving distances. Fit and save a model with:
+#   python drv_estimator.py <dbstring> [--out drv_model.json]
+
+import argparse
+import json
+import sys
+import numpy as np
+import pandas as pd
+
+class DrivingEstimator:
+    ''' Estimates driving distance as beta*geodesic and driving time as k*driving
+        distance. Coefficients are fitted by least squares for every building and origin
+        state, every building and globally. The most specific group with at least
+        min_samples rows is used for every pair
+    '''
+    def __init__(self, min_samples = 20, cutoff = 600, beta = 1.27714323, speed = 60):
+        ''' beta and speed are the defaults used before fitting '''
+        self.min_samples = min_samples
+        self.cutoff = cutoff
+        self.global_coef = (beta, 1.0/speed)
+        self.building_coef = {}
+        self.region_coef = {}
+
+    @staticmethod
+    def _coef(grp):
+        ''' Least squares coefficients through the origin of a group '''
+        g, d, t = grp['geodesic_distance'], grp['driving_distance'], grp['driving_time']
+        return (float((g*d).sum()/(g*g).sum()), float((d*t).sum()/(d*d).sum()), int(grp.shape[0]))
+
+    def fit(self, lookup):
+        ''' Fit the model from a dataframe with building_code, state_province,
+            geodesic_distance, driving_distance and driving_time. Only rows with real
+            positive distances under the cutoff are used
+        '''
+        df = lookup[(lookup['geodesic_distance'] > 0) & (lookup['geodesic_distance'] < self.cutoff) &
+                    (lookup['driving_distance'] > 0) & (lookup['driving_time'] > 0)]
+        if df.shape[0] == 0:
+            print('Error: No driving distances available to fit the estimator', file=sys.stderr)
+            return self
+        df = df.sort_values(['building_code','state_province','geodesic_distance'])
+
+        beta, k, _ = self._coef(df)
+        self.global_coef = (beta, k)
+        self.building_coef = {}
+        self.region_coef = {}
+        for b, grp in df.groupby('building_code'):
+            beta, k, n = self._coef(grp)
+            if n >= self.min_samples:
+                self.building_coef[b] = (beta, k)
+        for (b, s), grp in df.groupby(['building_code','state_province']):
+            beta, k, n = self._coef(grp)
+            if n >= self.min_samples:
+                self.region_coef[(b, s)] = (beta, k)
+        return self
+
+    def coefficients(self, building_codes, states = None):
+        ''' Arrays beta and k for every pair '''
+        building_codes = list(building_codes)
+        states = [None]*len(building_codes) if states is None else list(states)
+        coef = [self.region_coef.get((b, s), self.building_coef.get(b, self.global_coef))
+                for b, s in zip(building_codes, states)]
+        coef = np.array(coef, dtype=float).reshape(-1, 2)
+        return coef[:, 0], coef[:, 1]
+
+    def predict(self, geo, building_codes, states = None):
+        ''' Driving distance and time for arrays of geodesic distances, buildings and
+            origin states in one pass. Pairs over the cutoff get -1
+        '''
+        geo = np.asarray(geo, dtype=float)
+        beta, k = self.coefficients(building_codes, states)
+        valid = geo < self.cutoff
+        drv = np.where(valid, geo*beta, -1)
+        return drv, np.where(valid, drv*k, -1)
+
+    def save(self, path):
+        ''' Save the model as json '''
+        model = {'min_samples': self.min_samples,
+                 'cutoff': self.cutoff,
+                 'global': list(self.global_coef),
+                 'building': {b: list(c) for b, c in sorted(self.building_coef.items())},
+                 'region': [[b, s] + list(c) for (b, s), c in sorted(self.region_coef.items())]}
+        with open(path, 'w') as f:
+            json.dump(model, f, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        ''' Load a model saved with save '''
+        with open(path) as f:
+            model = json.load(f)
+        est = cls(model['min_samples'], model['cutoff'])
+        est.global_coef = tuple(model['global'])
+        est.building_coef = {b: tuple(c) for b, c in model['building'].items()}
+        est.region_coef = {(b, s): (beta, k) for b, s, beta, k in model['region']}
+        return est
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fit the driving distance estimator')
+    parser.add_argument('dbstring')
+    parser.add_argument('--out', default='drv_model.json')
+    parser.add_argument('--min-samples', type=int, default=20)
+    args = parser.parse_args()
+
+    lookup = pd.read_sql('SELECT building_code, state_province, geodesic_distance, driving_distance, driving_time FROM distance_lookup', args.dbstring)
+    est = DrivingEstimator(args.min_samples).fit(lookup)
+    est.save(args.out)
+    print(f'Estimator fitted: global {est.global_coef}, {len(est.building_coef)} buildings, {len(est.region_coef)} regions')
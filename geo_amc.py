@@ -6,41 +6,150 @@
 import pandas as pd
 import numpy as np
 from geopy import distance
-from geopy.geocoders import Nominatim
 from geopy.point import Point
-import re, pgeocode 
-import requests, json
+import re
 import sys
 import sqlalchemy as db
+from zip_table import ZipTable, load_postal_table
+from distance_cache import DistanceCache
+from bing import BingDistanceMatrix, BING_URL
+from geocode_cache import GeocodeCache
+from distance_matrix import DistanceMatrix
+from buildings import BuildingStore
+from spatial_index import SpatialIndex, zip3_centroids
+from drv_estimator import DrivingEstimator
+import shared_geo
+
+# WGS-84 ellipsoid parameters (meters) and conversion to miles
+WGS84_A = 6378137.0
+WGS84_F = 1/298.257223563
+WGS84_B = WGS84_A*(1 - WGS84_F)
+EARTH_RADIUS_MI = 3958.7613  # Mean earth radius in miles
+METERS_MILE = 1609.344
+
+def haversine_distance(lat1, lon1, lat2, lon2):
+    ''' Vectorized great circle distance in miles. Inputs are arrays (or scalars)
+        of coordinates in degrees and are broadcasted together
+    '''
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype=float)) for x in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1)/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((lon2 - lon1)/2)**2
+    return 2*EARTH_RADIUS_MI*np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def ellipsoidal_distance(lat1, lon1, lat2, lon2, max_iter = 200, tol = 1e-12):
+    ''' Vectorized distance in miles over the WGS-84 ellipsoid using Vincenty's
+        inverse formula. Pairs that do not converge (nearly antipodal points)
+        fall back to the haversine distance
+    '''
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(*(np.asarray(x, dtype=float) for x in (lat1, lon1, lat2, lon2)))
+    a, b, f = WGS84_A, WGS84_B, WGS84_F
+
+    L = np.radians(lon2 - lon1)
+    U1 = np.arctan((1 - f)*np.tan(np.radians(lat1)))
+    U2 = np.arctan((1 - f)*np.tan(np.radians(lat2)))
+    sinU1, cosU1 = np.sin(U1), np.cos(U1)
+    sinU2, cosU2 = np.sin(U2), np.cos(U2)
+
+    # Iterate over all pairs at once until lambda converges
+    lam = L.copy()
+    converged = np.zeros(L.shape, dtype=bool)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(max_iter):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.sqrt((cosU2*sin_lam)**2 + (cosU1*sinU2 - sinU1*cosU2*cos_lam)**2)
+            cos_sigma = sinU1*sinU2 + cosU1*cosU2*cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(sin_sigma == 0, 0, cosU1*cosU2*sin_lam/sin_sigma)
+            cos2_alpha = 1 - sin_alpha**2
+            # Equatorial lines have cos2_alpha = 0
+            cos_2sm = np.where(cos2_alpha == 0, 0, cos_sigma - 2*sinU1*sinU2/cos2_alpha)
+            C = f/16*cos2_alpha*(4 + f*(4 - 3*cos2_alpha))
+            lam_prev = lam
+            lam = L + (1 - C)*f*sin_alpha*(sigma + C*sin_sigma*(cos_2sm + C*cos_sigma*(-1 + 2*cos_2sm**2)))
+            converged = (np.abs(lam - lam_prev) < tol) | np.isnan(lam)
+            if converged.all():
+                break
+
+        u2 = cos2_alpha*(a**2 - b**2)/b**2
+        A = 1 + u2/16384*(4096 + u2*(-768 + u2*(320 - 175*u2)))
+        B = u2/1024*(256 + u2*(-128 + u2*(74 - 47*u2)))
+        d_sigma = B*sin_sigma*(cos_2sm + B/4*(cos_sigma*(-1 + 2*cos_2sm**2)
+                    - B/6*cos_2sm*(-3 + 4*sin_sigma**2)*(-3 + 4*cos_2sm**2)))
+        dist = b*A*(sigma - d_sigma)/METERS_MILE
+
+    # Coincident points and non convergent pairs
+    dist = np.where(sin_sigma == 0, 0.0, dist)
+    fallback = ~converged
+    if fallback.any():
+        dist = np.where(fallback, haversine_distance(lat1, lon1, lat2, lon2), dist)
+
+    return dist
+
+def batch_distance(lat1, lon1, lat2, lon2, mode = 'ellipsoidal'):
+    ''' Compute distances in miles between arrays of origins and destinations in a single
+        vectorized call. Mode can be 'haversine' (fast, spherical) or 'ellipsoidal'
+        (WGS-84, same as geopy geodesic). Missing coordinates (NaN) return -1
+    '''
+    if mode == 'haversine':
+        dist = haversine_distance(lat1, lon1, lat2, lon2)
+    elif mode == 'ellipsoidal':
+        dist = ellipsoidal_distance(lat1, lon1, lat2, lon2)
+    else:
+        raise ValueError(f'Unknown distance mode: {mode}')
+
+    return np.where(np.isnan(dist), -1, dist)
+
+# Patterns used to find zip codes
+ZIP_US_RE = re.compile(r'(\d{4,5})')
+ZIP_CA_RE = re.compile(r'(\w\d\w)\s{0,1}\d\w\d')
+FSA_RE = re.compile(r'(\w\d\w)(?:\s{0,1}\d\w\d)?')
 
 class GeoOperations:
     ''' Geopraphic operations for AMC: Computes point coordinates, computes distances, 
         either geodesic or driving over single points or sets 
     '''
-    def __init__(self, uszipfile, key, dbstring, sep = ';', dbschema = ""):
+    def __init__(self, uszipfile, key, dbstring, sep = ';', dbschema = "", cache_size = 100000,
+                 bing_url = BING_URL, geocode_file = 'geocode_cache.sqlite', geocode_resolver = None,
+                 distance_matrix = None, drv_model = None, shared_dir = None):
         """ Initialize all required information to operate"""
-        try:
-            # Load data file with US zip data
-            self.uszip = pd.read_csv(uszipfile, sep=sep)
-        except:
-            print('Error: Could not load zip code data',file=sys.stderr)
-            sys.exit(1)
-        # Initialize geolocator
-        self.geolocator = Nominatim(user_agent='amc')
+        # Tables published by a parent process are attached instead of loaded (see shared_geo.py)
+        shared = None if shared_dir == None else shared_geo.attach(shared_dir)
+        if shared != None:
+            self.zip_table = shared[0]
+        else:
+            try:
+                # Load data file with US zip data indexed by zip code (binary cache of the csv)
+                self.zip_table = ZipTable.from_cache(uszipfile, sep=sep)
+            except:
+                print('Error: Could not load zip code data',file=sys.stderr)
+                sys.exit(1)
+        # Initialize geolocator for international places, backed by a persistent cache
+        self.geocode_cache = GeocodeCache(geocode_file, geocode_resolver)
 
         # Initialize data for Bing API
-        self.bing = 'https://dev.virtualearth.net/REST/v1/Routes/DistanceMatrix'
+        self.bing = bing_url
         self.key = key
+        self.bing_client = BingDistanceMatrix(key, bing_url)
         self.km_mile = 1.60934 #Km per mile
         self.beta = 1.27714323 #Regressor value computed 
         self.speed = 60 # Average speed used to estimate time
+        # Fitted driving distance estimator (see drv_estimator.py), beta and speed otherwise
+        self.drv_estimator = DrivingEstimator(beta=self.beta, speed=self.speed)
+        if drv_model != None:
+            try:
+                self.drv_estimator = DrivingEstimator.load(drv_model)
+            except (IOError, ValueError, KeyError):
+                print(f'Error: Could not load driving estimator {drv_model}', file=sys.stderr)
         
-        # Initialize the database connection
-        if dbschema == "":
-            self.pgsql = db.create_engine(dbstring)
-        else:
-            self.pgsql = db.create_engine(dbstring,
-                     connect_args={'options':'-csearch_path={}'.format(dbschema)})
+        # The database connection and the buildings are loaded on first use
+        self._dbstring = dbstring
+        self._dbschema = dbschema
+        self._pgsql = None
+        self._amc_buildings = None if shared == None else shared[1]
+        self._buildings = None
+        # Spatial indexes are built on first use
+        self._zip_index = None
+        self._zip3 = None
+        self._building_index = None
         
         # Initialize the structure of the database of distances
         meta = db.MetaData()
@@ -57,25 +166,134 @@ class GeoOperations:
             db.Column('driving_distance', db.Float),
             db.Column('driving_time', db.Float),
         )
-        
-        # Get building data from database
-        query_bldgs = "Select building_code, building_name, latitude, longitude, geo_dst_near_airport, geo_dst_intl_airport, drv_dst_near_airport, drv_time_near_airport, drv_dst_intl_airport, drv_time_intl_airport, nearest_airport, international_airport from amc_building"
+        # Lookups on the distance table are served from memory
+        self._cache_size = cache_size
+        self._distance_cache = None
+        # Precomputed distances for US zips (see distance_matrix.py)
+        self.distance_matrix = None
+        if distance_matrix != None:
+            try:
+                self.distance_matrix = DistanceMatrix(distance_matrix)
+            except IOError:
+                print(f'Error: Could not load distance matrix {distance_matrix}', file=sys.stderr)
+
+    @property
+    def pgsql(self):
+        ''' Database engine, created on first use '''
+        if self._pgsql == None:
+            if self._dbschema == "":
+                self._pgsql = db.create_engine(self._dbstring)
+            else:
+                self._pgsql = db.create_engine(self._dbstring,
+                         connect_args={'options':'-csearch_path={}'.format(self._dbschema)})
+        return self._pgsql
+
+    @property
+    def distance_cache(self):
+        ''' Cache of the distance lookup table, created on first use '''
+        if self._distance_cache == None:
+            self._distance_cache = DistanceCache(self.pgsql, self.facilities_distance, self._cache_size)
+        return self._distance_cache
+
+    @property
+    def amc_buildings(self):
+        ''' AMC building data, queried from the database on first use '''
+        if self._amc_buildings is None:
+            # Get building data from database
+            query_bldgs = "Select building_code, building_name, latitude, longitude, geo_dst_near_airport, drv_dst_near_airport, drv_time_near_airport, geo_dst_intl_airport, drv_dst_intl_airport, drv_time_intl_airport, nearest_airport, international_airport from amc_building"
+            try:
+                with self.pgsql.connect() as conn:
+                    amc_bldgs = conn.execute(query_bldgs).fetchall()
+            except:
+                print("Could not query database for AMC buildings")
+                sys.exit(1)
+            
+            # Put everything on memory
+            df = []
+            for bld_code, name, lat, lon, gd_na, dd_na, dt_na, gd_ia, dd_ia, dt_ia, na, ia in amc_bldgs:
+                df.append([bld_code,name,lat,lon, gd_na, dd_na, dt_na, gd_ia, dd_ia, dt_ia, na, ia])
+            
+            # Manage AMC building data as a pandas dataframe
+            self._amc_buildings = pd.DataFrame(df, columns = ['building_code','name','lat','lon','gd_na','dd_na','dt_na','gd_ia','dd_ia','dt_ia','na','ia'])
+        return self._amc_buildings
+
+    @property
+    def buildings(self):
+        ''' AMC buildings indexed by building code '''
+        if self._buildings == None:
+            self._buildings = BuildingStore(self.amc_buildings)
+        return self._buildings
+
+    @property
+    def zip_index(self):
+        ''' Spatial index over the zip code centroids '''
+        if self._zip_index == None:
+            self._zip_index = SpatialIndex(self.zip_table.lat, self.zip_table.lon)
+        return self._zip_index
+
+    @property
+    def building_index(self):
+        ''' Spatial index over the AMC buildings (rows of buildings.frame) '''
+        if self._building_index == None:
+            frame = self.buildings.frame
+            self._building_index = SpatialIndex(frame['lat'].astype(float), frame['lon'].astype(float))
+        return self._building_index
+
+    def nearest_zip(self, lat, lon):
+        ''' Nearest known zip code to every point. Returns a dataframe with zip, distance
+            (miles), lat, lon, state and city
+        '''
+        dist, idx = np.atleast_1d(*self.zip_index.nearest(lat, lon))
+        found = idx < len(self.zip_table)
+        zips = pd.Series(self.zip_table.zips[np.where(found, idx, 0)]).map('{:05d}'.format).where(found, None)
+        res = self.zip_table.lookup_zips(zips)
+        res.insert(0, 'distance', np.where(found, dist, -1))
+        res.insert(0, 'zip', zips)
+        return res
+
+    def nearest_building(self, lat, lon):
+        ''' Nearest AMC building to every point. Returns a dataframe with building_code
+            and distance (miles)
+        '''
+        dist, idx = np.atleast_1d(*self.building_index.nearest(lat, lon))
+        codes = np.append(self.buildings.frame.index.values.astype(object), None)
+        return pd.DataFrame({'building_code': codes[idx], 'distance': np.where(np.isinf(dist), -1, dist)})
+
+    def zips_within(self, lat, lon, radius):
+        ''' Zip codes within radius miles of every point, or of the point for scalar lat, lon '''
+        rows = self.zip_index.within(lat, lon, radius)
+        if np.ndim(lat) == 0 and np.ndim(lon) == 0:
+            return [f'{z:05d}' for z in self.zip_table.zips[rows]]
+        return [[f'{z:05d}' for z in self.zip_table.zips[r]] for r in rows]
+
+    def snap_zip(self, zipc):
+        ''' Locate a zip code that is not in the zip tables (partial or retired zips) by
+            snapping the centroid of its 3 digit area to the nearest known zip. Returns
+            (lat, lon, state, city) of that zip or None if the area is unknown
+        '''
+        if self._zip3 is None:
+            self._zip3 = zip3_centroids(self.zip_table)
         try:
-            conn = self.pgsql.connect()
-            amc_bldgs = conn.execute(query_bldgs)
-        except:
-            print("Could not query database for AMC buildings")
-            sys.exit(1)
-        
-        # Put everything on memory
-        df = []
-        for bld_code, name, lat, lon, gd_na, dd_na, dt_na, gd_ia, dd_ia, dt_ia, na, ia in amc_bldgs:
-            df.append([bld_code,name,lat,lon, gd_na, dd_na, dt_na, gd_ia, dd_ia, dt_ia, na, ia])
-        
-        # Manage AMC building data as a pandas dataframe
-        self.amc_buildings = pd.DataFrame(df, columns = ['building_code','name','lat','lon','gd_na','dd_na','dt_na','gd_ia','dd_ia','dt_ia','na','ia'])
-        
-        
+            zip3 = int(zipc)//100
+        except (TypeError, ValueError):
+            return None
+        if zip3 not in self._zip3.index:
+            return None
+        c = self._zip3.loc[zip3]
+        _, idx = self.zip_index.nearest(c['lat'], c['lon'])
+        i = int(idx)
+        return (self.zip_table.lat[i], self.zip_table.lon[i], self.zip_table.state[i], self.zip_table.city[i])
+
+    @property
+    def us_postal(self):
+        ''' US postal codes from pgeocode, used for zips missing in the zip file '''
+        return load_postal_table('us')
+
+    @property
+    def ca_postal(self):
+        ''' Canadian FSA codes from pgeocode '''
+        return load_postal_table('ca')
+
     def get_zip_state_from_address(self, addrs):
         ''' Return the zip code and the country from an addrs string. This only
             works for US and Canada, otherwise the returned will be an empty object
@@ -94,7 +312,7 @@ class GeoOperations:
         if co == 'US':
             loc_data['country'] = 'US'
             # Find zip code
-            zipus = re.search(r'\d{4,5}', addrs)
+            zipus = ZIP_US_RE.search(addrs)
             
             if zipus != None:
                 # Zip code found in text
@@ -110,7 +328,7 @@ class GeoOperations:
         elif co == 'CA':
             # Lookup for Canadian zip-code
             loc_data['country'] = 'CA'
-            zipca = re.search(r'\w\d\w\s{0,1}\d\w\d',addrs)
+            zipca = ZIP_CA_RE.search(addrs)
             
             if zipca != None:
                 # Zip code found 
@@ -128,6 +346,33 @@ class GeoOperations:
 
         return loc_data
         
+    def get_zip_state_from_columns(self, zips, countries, allow_fsa = False):
+        ''' Column version of get_zip_state_from_address. Takes the zip_postal_code and
+            country_code series and returns a dataframe aligned with them with columns
+            zip (US zip, Canadian FSA or INTL), fsa (normalized Canadian FSA) and country.
+            If allow_fsa is True a Canadian code with only the FSA is accepted
+        '''
+        zips = pd.Series(zips).astype(str)
+        country = pd.Series(countries, index=zips.index).astype(str).str.split(',').str[-1].str.strip().str.upper()
+        is_us = country == 'US'
+        is_ca = country == 'CA'
+        
+        # US zip codes, 4 digit codes lost the leading zero
+        zipus = zips[is_us].str.extract(ZIP_US_RE, expand=False).str.zfill(5)
+        # Canadian codes, only the FSA is kept
+        ca_re = FSA_RE if allow_fsa else ZIP_CA_RE
+        zipca = zips[is_ca].str.extract(ca_re, expand=False).str.upper()
+        
+        zipc = pd.Series('INTL', index=zips.index, dtype=object)
+        zipc[is_us] = zipus
+        zipc[is_ca] = zipca
+        fsa = pd.Series(None, index=zips.index, dtype=object)
+        fsa[is_ca] = zipca
+        zipc = zipc.where(zipc.notnull(), None)
+        fsa = fsa.where(fsa.notnull(), None)
+        
+        return pd.DataFrame({'zip': zipc, 'fsa': fsa, 'country': country})
+
     def get_coordinates_from_address(self, addrs):
         ''' Return coordinates from address from Canada and US. Will use the same
             structure as the function get_zip_state_from_address and complete it
@@ -139,49 +384,55 @@ class GeoOperations:
         if loc_data['zip'] != None:
             # Find coordinates for US address
             if loc_data['country'] == 'US':
-                zipc = int(loc_data['zip'])
-                reg = self.uszip[self.uszip['Zip'] == zipc].reset_index()
+                reg = self.zip_table.lookup(loc_data['zip'])
                 # Test if zip code was found
-                if reg.empty == False:
+                if reg != None:
                     # It is not empty, update
-                    loc_data['point'] = Point(reg.geopoint[0])
-                    loc_data['state'] = reg.State[0]
-                    loc_data['city'] = reg.City[0]
+                    lat, lon, loc_data['state'], loc_data['city'] = reg
+                    loc_data['point'] = Point(lat, lon)
                 else:
                     # Try to find the place by other means
-                    nomi = pgeocode.Nominatim('us')
-                    a = nomi.query_postal_code(loc_data['zip'])
+                    reg = self.us_postal.lookup(loc_data['zip'])
                     # Verify if it was found
-                    if not np.isnan(a.latitude) and not np.isnan(a.longitude):
-                        loc_data['point'] = Point(a.latitude, a.longitude)
-                        loc_data['state'] = a.state_code
-                        loc_data['city'] = a.place_name
+                    if reg != None:
+                        lat, lon, loc_data['state'], loc_data['city'] = reg
+                        loc_data['point'] = Point(lat, lon)
+                    else:
+                        # Snap to the nearest known zip in the same area. Only the point is
+                        # used (for distances), state and city are not known and stay None
+                        reg = self.snap_zip(loc_data['zip'])
+                        if reg != None:
+                            print(f'Zip {loc_data["zip"]} not found, snapped to {reg[3]}, {reg[2]}', file=sys.stderr)
+                            loc_data['point'] = Point(reg[0], reg[1])
         
             elif loc_data['country'] == 'CA':
-                # Find Canadian address
-                nomi = pgeocode.Nominatim('ca')
-                a = nomi.query_postal_code(loc_data['zip'])
+                # Find Canadian address (FSA)
+                reg = self.ca_postal.lookup(loc_data['zip'])
                 # Verify that was found
-                if not np.isnan(a.latitude) and not np.isnan(a.longitude):
-                    loc_data['point'] = Point(a.latitude, a.longitude)
-                    loc_data['state'] = a.state_code
-                    loc_data['city'] = a.place_name
-                    loc_data['zip'] = a.postal_code
+                if reg != None:
+                    lat, lon, loc_data['state'], loc_data['city'] = reg
+                    loc_data['point'] = Point(lat, lon)
 
             else:
-                # Find international location
-                geolocator = Nominatim(user_agent="AMC")
-                try:
-                    loc = geolocator.geocode(loc_data['country'])
-                except:
-                    loc = None
-                    print(f'Error trying to locate: {loc_data["country"]}')
-
-                if loc != None:
-                    loc_data['point'] = Point(loc[1])
+                # Find international location, the network is used only for new places
+                p = self.geocode_cache.get(loc_data['country'])
+                if p != None:
+                    loc_data['point'] = Point(p[0], p[1])
 
         return loc_data
-    
+
+    def get_coordinates_from_columns(self, zips, countries):
+        ''' Column version of get_coordinates_from_address. Every distinct pair of zip
+            and country is resolved once and the results are repeated for all rows.
+            Returns a dataframe with zip, state, city, country and point in the order
+            of the input
+        '''
+        addrs = pd.Series([f'{z}, {c}' for z, c in zip(zips, countries)], dtype=object)
+        codes, uniques = pd.factorize(addrs)
+        locs = pd.DataFrame([self.get_coordinates_from_address(a) for a in uniques],
+                            columns=['zip','state','city','country','point'])
+        return locs.iloc[codes].reset_index(drop=True)
+
     def compute_geo_distance(self, **kwargs):
         ''' Returns geodesic distance in Km '''
         p1 = p2 = None
@@ -221,20 +472,22 @@ class GeoOperations:
 
     def _driving_distance(self, p1,p2):
         ''' Returns driving distance from Bing and time as well'''
-        params =  { "origins":'%f,%f'%(p1.latitude,p1.longitude),
-                    "destinations":'%f,%f'%(p2.latitude,p2.longitude),
-                    "travelMode":'driving',
-                    "key":self.key}
-        payload_str = '&'.join('%s=%s' % (k,v) for k,v in params.items())
-        response = requests.get(self.bing, params = payload_str)
-        if response.status_code == 200:
-            resp = response.json()
-            results = resp['resourceSets'][0]['resources'][0]['results'][0]
-            return(results['travelDistance']/self.km_mile, results['travelDuration'])
+        res = self.bing_client.request([(p1.latitude, p1.longitude)], [(p2.latitude, p2.longitude)])
+        if res != None:
+            return (res[0][0,0], res[1][0,0])
         else:
-            print('Error when using Bing API', file=sys.stderr)
             return (-1,-1)
 
+    def compute_driving_distances(self, pairs, concurrency = 1, timeout = 120, progress = None):
+        ''' Driving distance and time for many pairs at once. Pairs is a dataframe with
+            building_code, lat_p and lon_p (origin). Requests are batched by building and
+            when concurrency > 1 up to that many requests run at the same time
+        '''
+        pending = self.buildings.join(pairs[['building_code','lat_p','lon_p']], ['lat','lon'])
+        
+        if concurrency > 1:
+            return self.bing_client.resolve_concurrent(pending, concurrency, timeout, progress)
+        return self.bing_client.resolve(pending)
 
     def compute_driving_distance(self, **kwargs):
         ''' Return driving distance in miles '''
@@ -283,20 +536,16 @@ class GeoOperations:
         
         # Lookup for nearest airport
         if loc_data['country'] != 'US' and loc_data['country'] != 'CA':
-            airport = self.amc_buildings[self.amc_buildings.building_code == building_code]['ia'].values[0] 
-            dist = self.amc_buildings[self.amc_buildings.building_code == building_code]['gd_ia'].values[0]
-            drv_dst = self.amc_buildings[self.amc_buildings.building_code == building_code]['dd_ia'].values[0]
-            drv_time = self.amc_buildings[self.amc_buildings.building_code == building_code]['dt_ia'].values[0]
+            bldg = self.buildings.get(building_code)
+            airport = bldg.ia
+            dist = bldg.gd_ia
+            drv_dst = bldg.dd_ia
+            drv_time = bldg.dt_ia
             if verbose == True:
                 print(f'Intl: [{building_code} <- {address}], assigning: {airport}') 
         else:
-            # Query the database
-            s = self.facilities_distance.select().where(db
-                    .and_(self.facilities_distance.c.building_code == building_code, 
-                            self.facilities_distance.c.zipcode == loc_data['zip']))
-            conn = self.pgsql.connect()
-            result = conn.execute(s)
-            dist_list = [r for r in result]
+            # Query the cache, database is used only if pair is not in memory
+            dist_list = self.distance_cache.get(building_code, loc_data['zip'])
             # Check that size is just 1
             if len(dist_list) == 0:
                 print(f'Pair [{building_code} <- {address}] not found in lookup table', file=sys.stderr)     
@@ -317,11 +566,12 @@ class GeoOperations:
                     else: 
                         if geo_dist >= 600:
                             # If distance is -1 (>600 miles), get airport data
-                            airport = self.amc_buildings[self.amc_buildings.building_code == building_code]['na'].values[0]
-                            #dist = self.amc_buildings[self.amc_buildings.building_code == building_code]['gd_na'].values[0]
+                            bldg = self.buildings.get(building_code)
+                            airport = bldg.na
+                            #dist = bldg.gd_na
                             dist = geo_dist
-                            drv_dst = self.amc_buildings[self.amc_buildings.building_code == building_code]['dd_na'].values[0]
-                            drv_time = self.amc_buildings[self.amc_buildings.building_code == building_code]['dt_na'].values[0]
+                            drv_dst = bldg.dd_na
+                            drv_time = bldg.dt_na
                             if verbose == True:
                                 print(f'Regional: [{building_code} <- {address}], assigning: {airport}') 
                         else:
@@ -332,10 +582,23 @@ class GeoOperations:
                      
         return (dist, drv_dst, drv_time, loc_data, building_code)
 
-    def compute_unique_block_geo_distance(self, block, year):
+    def preload_distances(self, block):
+        ''' Load into the distance cache all pairs of a block with building_code,
+            zip_postal_code and country_code in a single query
+        '''
+        unique_travel = block[['building_code','zip_postal_code','country_code']].drop_duplicates()
+        # Canadian codes in the lookup table only keep the FSA
+        parsed = self.get_zip_state_from_columns(unique_travel['zip_postal_code'], unique_travel['country_code'], allow_fsa = True)
+        known = parsed['country'].isin(['US','CA']) & parsed['zip'].notnull()
+        pairs = zip(unique_travel['building_code'][known], parsed['zip'][known])
+        
+        return self.distance_cache.preload(pairs)
+
+    def compute_unique_block_geo_distance(self, block, year, mode = 'ellipsoidal'):
         ''' Compute distances over a block on pandas which requires to have the following:
             building_code, zip_postal_code, state_code and country_code. 
-            The output will be annotated with errors found 
+            The output will be annotated with errors found. Distances are computed in a 
+            single vectorized call using batch_distance with the given mode
         '''
         
         # Create unique origin - destination pairs
@@ -344,52 +607,74 @@ class GeoOperations:
                                        'zip_postal_code',
                                        'country_code']).size().reset_index(name='Freq')
         
-        d_to_find = unique_travel.set_index('building_code').join(self.amc_buildings.set_index('building_code'))
+        d_to_find = self.buildings.join(unique_travel).set_index('building_code')
         
-        # Compute distance for every pair
-        dist_r = []
-        state = []
-        city = []
-        zipc = []
-        country = []
-        point = []
+        # Resolve every origin only once, the same origin is shared by many buildings
+        origins = d_to_find['zip_postal_code'] + ', ' + d_to_find['country_code']
+        locations = {addrs: self.get_coordinates_from_address(addrs) for addrs in origins.unique()}
+        locs = [locations[addrs] for addrs in origins]
         
-        # Iterate over all items in block
-        for _, row in d_to_find.iterrows():
-            zip1 = row['zip_postal_code'] + ', ' + row['country_code']
-            p2 = Point(float(row['lat']),float(row['lon']))
-            # Get geodesic distance only
-            dist, loc, _ = self.compute_geo_distance(zip1 = zip1, p2 = p2)    
-            # Append columns
-            dist_r.append(dist)
-            state.append(loc['state'])
-            city.append(loc['city'])
-            zipc.append(loc['zip'])
-            country.append(loc['country'])
-            point.append(loc['point'])
+        # Origin coordinates, missing points are NaN so distance is -1
+        lat_p = np.array([np.nan if loc['point'] == None else loc['point'].latitude for loc in locs])
+        lon_p = np.array([np.nan if loc['point'] == None else loc['point'].longitude for loc in locs])
+        
+        # Compute distance for every pair in one call
+        dist_r = batch_distance(lat_p, lon_p, 
+                                d_to_find['lat'].astype(float).values, 
+                                d_to_find['lon'].astype(float).values, mode)
         
         assert(len(dist_r) == d_to_find.shape[0])
         d_to_find['distance'] = dist_r
-        d_to_find['state_province_code'] = state
-        d_to_find['city'] = city
-        d_to_find['zip_postal_code'] = zipc
-        d_to_find['country_code'] = country
-        d_to_find['point'] = point
+        d_to_find['state_province_code'] = [loc['state'] for loc in locs]
+        d_to_find['city'] = [loc['city'] for loc in locs]
+        d_to_find['zip_postal_code'] = [loc['zip'] for loc in locs]
+        d_to_find['country_code'] = [loc['country'] for loc in locs]
+        d_to_find['point'] = [loc['point'] for loc in locs]
+        d_to_find['lat_p'] = lat_p
+        d_to_find['lon_p'] = lon_p
         d_to_find['year'] = year
         
         return d_to_find
         
-    def get_distances(self, address, building_code, use_api = False, cutoff = 600):
+    def estimate_driving_distances(self, geo, building_codes, states = None, cutoff = 600):
+        ''' Estimate driving distance and time for arrays of geodesic distances, buildings
+            and origin states in a single pass
+        '''
+        drv, tm = self.drv_estimator.predict(geo, building_codes, states)
+        geo = np.asarray(geo, dtype=float)
+        return np.where(geo < cutoff, drv, -1), np.where(geo < cutoff, tm, -1)
+
+    def matrix_distances(self, loc_data, building_code):
+        ''' Estimated (geodesic, driving distance, driving time) of a US origin from the
+            precomputed matrix, (None, None, None) if not available. loc_data is completed
+            with the location of the zip code
+        '''
+        if self.distance_matrix == None or loc_data['country'] != 'US':
+            return (None, None, None)
+        dst = self.distance_matrix.lookup(loc_data['zip'], building_code)
+        reg = self.zip_table.lookup(loc_data['zip'])
+        if dst == None or reg == None or dst[0] < 0:
+            return (None, None, None)
+        lat, lon, loc_data['state'], loc_data['city'] = reg
+        loc_data['point'] = Point(lat, lon)
+        return dst
+
+    def get_distances(self, address, building_code, use_api = False, cutoff = 600, estimate = True):
         ''' Get both driving and geodesic distances between AMC facility and a guest
-            by looking up on the database or trying to find through the available resources
+            by looking up on the database or trying to find through the available resources.
+            If estimate is False new pairs are returned without driving distance (None)
         '''
         geo_d, drv_d, drv_t, loc_data, amc_bldg = self.lookup_distances(address,building_code)
+
+        # New US pairs are estimated from the precomputed matrix if available
+        if geo_d == None and use_api == False and estimate == True:
+            geo_d, drv_d, drv_t = self.matrix_distances(loc_data, amc_bldg)
         
         if geo_d == None:
             # Try lo lookup for data, this address is new
             # First lookup for building coordinates
-            qry_bldg = self.amc_buildings[self.amc_buildings['building_code'] == amc_bldg]
-            build_coord = Point(float(qry_bldg['lat']),float(qry_bldg['lon']))
+            bldg = self.buildings.get(amc_bldg)
+            build_coord = Point(float(bldg.lat),float(bldg.lon))
             
             # Compute geo_distance
             geo_d, loc_data, _ = self.compute_geo_distance(zip1 = address, p2 = build_coord)
@@ -401,10 +686,11 @@ class GeoOperations:
                     drv_dist, loc_data, _ = self.compute_driving_distance(zip1 = address, p2 = build_coord)
                     drv_d = drv_dist[0]
                     drv_t = drv_dist[1]
-                else:
-                    # Use linear estimation
-                    drv_d = geo_d*self.beta
-                    drv_t = drv_d/self.speed
+                elif estimate == True:
+                    # Use the fitted linear estimation
+                    drv, tm = self.estimate_driving_distances([geo_d], [amc_bldg], [loc_data['state']], cutoff)
+                    drv_d = drv[0]
+                    drv_t = tm[0]
             else:
                     drv_d = -1
                     drv_t = -1
@@ -0,0 +1,87 @@
+# Persistent geocode cache for AMC
+
+import sqlite3
+import sys
+import threading
+from geopy.geocoders import Nominatim
+
+class NominatimResolver:
+    ''' Resolve places over the network with geopy Nominatim '''
+    def __init__(self, user_agent = 'AMC'):
+        self.geolocator = Nominatim(user_agent=user_agent)
+
+    def geocode(self, query):
+        ''' Return (lat, lon) of a query or None if not found. Network errors are raised '''
+        loc = self.geolocator.geocode(query)
+        if loc == None:
+            return None
+        return (loc.latitude, loc.longitude)
+
+class StaticResolver:
+    ''' Resolve places from a dictionary, used to run offline '''
+    def __init__(self, places):
+        self.places = {GeocodeCache.normalize(k): v for k, v in places.items()}
+
+    def geocode(self, query):
+        return self.places.get(GeocodeCache.normalize(query))
+
+class GeocodeCache:
+    ''' Key-value store of geocoded places in a SQLite file. Keys are normalized
+        country names or addresses. The file is shared by all jobs and workers, so a
+        place is resolved over the network only once. Any object with a geocode(query)
+        method returning (lat, lon) or None can be used as resolver
+    '''
+    def __init__(self, path = 'geocode_cache.sqlite', resolver = None):
+        ''' Use path=':memory:' to keep the cache only in this process '''
+        self.path = path
+        self.resolver = NominatimResolver() if resolver == None else resolver
+        self.memory = {}
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS geocode (key TEXT PRIMARY KEY, lat REAL, lon REAL)')
+
+    @staticmethod
+    def normalize(key):
+        ''' Normalized key: single spaces, no surrounding spaces or commas, upper case '''
+        return ' '.join(str(key).replace(',', ' ').split()).upper()
+
+    def _read(self, key):
+        ''' Return the stored row for key, None if the key was never resolved '''
+        with self._lock:
+            row = self.conn.execute('SELECT lat, lon FROM geocode WHERE key = ?', (key,)).fetchone()
+        if row == None:
+            return None
+        # Places resolved but not found are stored with null coordinates
+        return (row[0], row[1])
+
+    def _write(self, key, point):
+        lat, lon = (None, None) if point == None else point
+        with self._lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO geocode (key, lat, lon) VALUES (?, ?, ?)', (key, lat, lon))
+
+    def get(self, query):
+        ''' Return (lat, lon) of a query or None if it can not be located. The resolver
+            is only used when the query is not in memory or in the file. Places not found
+            are stored too, errors of the resolver are not
+        '''
+        key = self.normalize(query)
+        if key not in self.memory:
+            row = self._read(key)
+            if row == None:
+                try:
+                    point = self.resolver.geocode(query)
+                except Exception:
+                    # Do not store failures, they will be retried later
+                    print(f'Error trying to locate: {query}', file=sys.stderr)
+                    return None
+                self._write(key, point)
+                row = (None, None) if point == None else point
+            self.memory[key] = None if row[0] == None else row
+        return self.memory[key]
+
+    def warm(self, queries):
+        ''' Resolve all queries given so later lookups are served from the cache '''
+        for q in set(queries):
+            self.get(q)
+        return len(self.memory)
@@ -5,20 +5,95 @@
 
 import pandas as pd
 import numpy as np
+from pandas.api.types import union_categoricals
+from concurrent.futures import ThreadPoolExecutor
 from geopy import Point
 from geo_amc import GeoOperations
 from os import listdir
 from os.path import isfile, join
 import re
+import sys
 import hashlib
-import random
 import string
 from mimesis import Person
 from mimesis import Address
 from mimesis import Generic
-from sys import exit
-
 
+# Declared types of the quarter file columns. Repeated codes are categorical, the rest
+# of the codes are kept as strings so zip codes keep their leading zeros. Other columns
+# are inferred. Reservation numbers are read as float, so blank numbers do not fail the
+# parse, and made integers when the rows without number are dropped
+RESERVATION_DTYPES = {'reservation_number': 'float64',
+                      'building_code': 'category',
+                      'rate_category': 'category',
+                      'country_code': 'category',
+                      'state_province_code': str,
+                      'zip_postal_code': str,
+                      'city_code': str,
+                      'group_type_code': str}
+RESERVATION_DATES = ['arrival_date', 'departure_date']
+
+# PII columns used to generate the UID
+PII_COLUMNS = ["first_name","last_name", "address_1", "address_2","city_code","state_province_code","zip_postal_code", "phone_number", "home_phone_number", "cell_phone_number", "email_address", "internet_address"]
+
+def int_reservations(df):
+    '''
+    Drop the rows without reservation number and make the reservation numbers integers
+    '''
+    blank = df['reservation_number'].isnull()
+    if blank.any():
+        print(f'Warning: {blank.sum()} rows without reservation number dropped', file=sys.stderr)
+        df = df[~blank]
+    return df.assign(reservation_number=df['reservation_number'].astype('int64'))
+
+def read_reservations(filename, **kwargs):
+    '''
+    Read a reservation csv file with the declared dtypes and dates. kwargs are passed to read_csv,
+    with chunksize an iterator over the chunks is returned
+    '''
+    header = pd.read_csv(filename, nrows=0).columns
+    reader = pd.read_csv(filename, dtype=RESERVATION_DTYPES,
+                         parse_dates=[c for c in RESERVATION_DATES if c in header], **kwargs)
+    if kwargs.get('chunksize') != None:
+        return (int_reservations(chunk) for chunk in reader)
+    return int_reservations(reader)
+
+# Fake replacements of the PII columns: column, prefix and kind of fake value
+FAKE_PII = [('first_name', 'fn_', 'first_name'),
+            ('last_name', 'ln_', 'last_name'),
+            ('address_1', 'a1_', 'address'),
+            ('address_2', 'a2_', 'address'),
+            ('phone_number', 'ph_', 'telephone'),
+            ('home_phone_number', 'home_', 'telephone'),
+            ('cell_phone_number', 'cell_', 'telephone'),
+            ('email_address', 'em_', 'email'),
+            ('internet_address', 'ia_', 'email'),
+            ('group_name', 'group_', 'word')]
+FAKE_POOL_SIZE = 1000
+SUFFIX_CHARS = np.array(list(string.ascii_lowercase + string.digits))
+
+def hash_values(values):
+    '''
+    SHA-256 hex digests of a list of strings. Hashing is done serially, a process pool
+    costs more in pickling the strings than it saves
+    '''
+    return [hashlib.sha256(v.encode()).hexdigest() for v in values]
+
+def fake_pools(seed = None, size = FAKE_POOL_SIZE):
+    '''
+    Arrays of size fake values of every kind in FAKE_PII, generated with mimesis from seed
+    '''
+    person = Person('en', seed=seed)
+    address = Address('en', seed=seed)
+    generic = Generic('en', seed=seed)
+    names = [person.full_name().split() for _ in range(size)]
+    pools = {'first_name': [n[0] for n in names],
+             'last_name': [n[1] for n in names],
+             'address': [address.address() for _ in range(size)],
+             'telephone': [person.telephone() for _ in range(size)],
+             'email': [person.email() for _ in range(size)],
+             'word': [generic.text.word() for _ in range(size)]}
+    return {k: np.array(v, dtype=object) for k, v in pools.items()}
 
 class preprocess:
     def __init__(self, geo):
@@ -27,26 +102,59 @@ class preprocess:
         '''
         self.geo = geo
 
-    def join_files(self, path, year):
+    def quarter_files(self, path, year):
         '''
-        Join quarter csv files that are in path over the year specified. 
-        The expected filename has the following structure: Q1_year_*.csv
+        Quarter csv files in path for the year, sorted in order of Q
         '''
         # Find all files in path
         file_list = [f for f in listdir(path) if isfile(join(path, f)) and re.match(f'^Q\\d_{year}\\w*.csv$', f)]
-        # Sort them in order of Q
         file_list.sort()
-        # Read files in pandas list
-        file_Q = []
-        for f in file_list:
-            print(f'Reading file {path}/{f}...')
-            df = pd.read_csv(join(path,f))
-            file_Q.append(df)
-        
-        amc_raw = pd.concat(file_Q)
+        return file_list
+
+    def join_files(self, path, year, workers = 4):
+        '''
+        Join quarter csv files that are in path over the year specified. 
+        The expected filename has the following structure: Q1_year_*.csv
+        Files are parsed concurrently with the declared dtypes
+        '''
+        files = [join(path,f) for f in self.quarter_files(path, year)]
+        print(f'Reading files {", ".join(files)}...')
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            file_Q = list(pool.map(read_reservations, files))
+        if len(file_Q) == 0:
+            return pd.DataFrame()
+
+        # Same categories in all files, so categorical columns are kept when joined
+        for col in file_Q[0].columns[file_Q[0].dtypes == 'category']:
+            cats = union_categoricals([df[col] for df in file_Q]).categories
+            for df in file_Q:
+                df[col] = df[col].cat.set_categories(cats)
+
+        amc_raw = pd.concat(file_Q, ignore_index=True)
 
         return amc_raw
 
+    def iter_files(self, path, year, chunksize = 100000):
+        '''
+        Read the quarter csv files of the year (same names as join_files) in chunks of
+        at most chunksize rows with the declared dtypes. Yields one dataframe per chunk
+        '''
+        for f in self.quarter_files(path, year):
+            print(f'Reading file {path}/{f} in chunks of {chunksize} rows...')
+            for chunk in read_reservations(join(path,f), chunksize=chunksize):
+                yield chunk
+
+    def stream_files(self, path, year, chunksize = 100000):
+        '''
+        Streaming version of join_files, filter_rate_category and validate_data. Every
+        chunk is filtered and validated as it is read, and (valid, errors, invalid) is
+        yielded per chunk, so memory is bounded by chunksize and not by the year
+        '''
+        for chunk in self.iter_files(path, year, chunksize):
+            df, df_err = self.filter_rate_category(chunk)
+            df, df_invalid = self.validate_data(df)
+            yield df, df_err, df_invalid
+
     def filter_rate_category(self, raw_df):
         '''
         Filter by rate_category. Only value of 'room' are valid data. Return both dataframes.
@@ -64,6 +172,10 @@ class preprocess:
         if 'UID' in raw_df.columns:
             raw_df = raw_df.drop(columns=['UID_grp'])
 
+        # Categorical codes are only used to read and join the files. They leave preprocess
+        # as object columns, so groupbys downstream don't create groups for unseen categories
+        raw_df = raw_df.astype({c: object for c in raw_df.columns[raw_df.dtypes == 'category']})
+
         # Get everything different than room (Should be discarded)
         df_wr = raw_df[raw_df['rate_category'] != 'room']
         # Get everyhing with room (equivalent to dropna in building_code)
@@ -77,210 +189,105 @@ class preprocess:
         Output is gonna be two dataframes, one with validated data and one with empty 
         guest address information
         '''
-        
-        prev_reservation = None
-        zip_lst = []
-        st_lst = []
-        co_lst = []
-        city_lst = []
-        loc = {}
-
-        def preprocess_guest_location(row):
-            '''
-            This function will be used with apply to validate all data.
-            Private function
-            '''
-            nonlocal prev_reservation, zip_lst, st_lst, co_lst, city_lst, loc 
-            reservation_n = row['reservation_number']
-            country = row['country_code']
-            zip_c = row['zip_postal_code']
-            
-            # This is the case where previous record is part of the same party
-            if prev_reservation == reservation_n:
-                zip_lst.append(loc['zip'])
-                st_lst.append(loc['state'])
-                co_lst.append(loc['country'])
-                city_lst.append(loc['city'])
-            else:
-            # Different record, do the lookup
-                loc = self.geo.get_coordinates_from_address(f'{zip_c}, {country}')
-                if loc['country'] == 'CA':
-                    if loc['zip'] != None:
-                        loc['zip'] += " 1X1"
-                zip_lst.append(loc['zip'])
-                st_lst.append(loc['state'])
-                co_lst.append(loc['country'])
-                city_lst.append(loc['city'])
-                
-            # Store previous reservation    
-            prev_reservation = reservation_n
-            # -- End of function --
-
         # Sort the data by reservation number
         sorted_df = filtered_df.sort_values(by=['reservation_number'])
 
-        # Modify arrival and departure as dates
-        valid_df = sorted_df.dropna(subset=['country_code'])
-        invalid_df = sorted_df[sorted_df['country_code'].isnull()]
+        # Records without country can not be validated. take returns a new frame, so
+        # the valid records are updated in place
+        valid = sorted_df['country_code'].notnull().values
+        invalid_df = sorted_df[~valid]
+        valid_df = sorted_df.take(np.flatnonzero(valid))
 
-        # Verify all data
-        _ = valid_df.apply(lambda row: preprocess_guest_location(row), axis=1)
+        # Look up every distinct zip and country once
+        loc = self.geo.get_coordinates_from_columns(valid_df['zip_postal_code'].values, 
+                                                    valid_df['country_code'].values)
+        is_ca = (loc['country'] == 'CA') & loc['zip'].notnull()
+        loc.loc[is_ca, 'zip'] = loc.loc[is_ca, 'zip'] + " 1X1"
 
         # Update fields with validated data
-        _valid_df = valid_df.copy()
-        _valid_df['zip_postal_code'] = zip_lst
-        _valid_df['state_province_code'] = st_lst
-        _valid_df['country_code'] = co_lst
-        _valid_df['city_code'] = city_lst
-
-        # Create Stay_Date field
-        _valid_df.insert(0,'Stay_Date', value = pd.to_datetime(dict(year=sorted_df.Stay_Year, 
-                                                                    month=sorted_df.Stay_Month, 
-                                                                    day=sorted_df.Stay_Day)))
-        
-        # Correct fields with dates 
-        _valid_df['arrival_date'] = pd.to_datetime(valid_df['arrival_date'] )
-        _valid_df['departure_date'] = pd.to_datetime(valid_df['departure_date'] )
+        valid_df['zip_postal_code'] = loc['zip'].values
+        valid_df['state_province_code'] = loc['state'].values
+        valid_df['country_code'] = loc['country'].values
+        valid_df['city_code'] = loc['city'].values
+
+        # Create Stay_Date field and correct fields with dates
+        valid_df.insert(0,'Stay_Date', value = pd.to_datetime(dict(year=valid_df.Stay_Year, 
+                                                                   month=valid_df.Stay_Month, 
+                                                                   day=valid_df.Stay_Day)))
+        valid_df['arrival_date'] = pd.to_datetime(valid_df['arrival_date'])
+        valid_df['departure_date'] = pd.to_datetime(valid_df['departure_date'])
 
         # Drop NA in zip_postal_code and update invalids
-        valid_df = _valid_df.dropna(subset = ['zip_postal_code'])
-        invalid_df1 = _valid_df[_valid_df['zip_postal_code'].isnull()]
-        invalid_df = pd.concat([invalid_df,invalid_df1])
+        no_zip = valid_df['zip_postal_code'].isnull()
+        invalid_df = pd.concat([invalid_df,valid_df[no_zip]])
+        valid_df = valid_df[~no_zip]
 
         return (valid_df, invalid_df)
 
-    def generate_UID(self, valid_df, generate_fake = False):
+    def generate_UID(self, valid_df, generate_fake = False, seed = None):
         '''
         Generate UIDs using PII fields in the data. Input should be validated data.
         Output is gonna be two dataframes, one with mapping data and one with updated validated data attached with a UID column in the  
         guest reservation data.       
+        Only distinct PII combinations are hashed.
+        seed is used for the fake data
         '''
 
         guest_data = valid_df
-  
-        #Taking as input the PII columns used to generate the UID 
-        column_names = ["first_name","last_name", "address_1", "address_2","city_code","state_province_code","zip_postal_code", "phone_number", "home_phone_number", "cell_phone_number", "email_address", "internet_address"]
-
-        counter = 0
-
-        #creating a new column UID
-        guest_data["UID"] = guest_data[column_names].apply(lambda x: '$'.join(x.astype(str)), axis = 1).str.replace(r'[^$@\w\s]','')
-
 
-        new_column = "UID"
-        #Generating mapping data for the PII fields and UID associated with it
-        mapping_data = [column_names]
-        mapping_data[counter].append(str(new_column))
-
-        #Generating the hash values
-        for i,row in guest_data.iterrows():
-            if (i%1000==0 and i!=0):
-                #print("Successfully ran ",i," number of rows to generate UIDs.....")
-                pass
-            value = str(row["UID"]).lower()
-            counter+=1
-            guest_data.at[i,new_column] = value
-            uid = hashlib.sha256(value.encode()).hexdigest()
-            mapping_data.append(value.split("$"))
-            mapping_data[counter].append(uid)
-            guest_data.at[i,new_column] = uid 
-
-        #print("Created UIDs for all PII columns ")  
+        # Normalized PII of every row, joined with $
+        pii = guest_data[PII_COLUMNS[0]].map(str).str.cat([guest_data[c].map(str) for c in PII_COLUMNS[1:]], sep='$')
+        pii = pii.str.replace(r'[^$@\w\s]', '', regex=True).str.lower()
 
+        # Hash every distinct combination once and map back to the rows
+        codes, uniques = pd.factorize(pii)
+        uids = np.array(hash_values(uniques), dtype=object)
+        guest_data["UID"] = uids[codes]
 
         #Generation of fake data
         if generate_fake == True:
             print("Running generate fake PIIS......")
-            guest_data = self.generate_fake_PIIs(guest_data)
-            #print("Done running....")
-
+            guest_data = self.generate_fake_PIIs(guest_data, seed)
 
-        #print("Created a new dataframe with the UIDs for each unique PII for the data as ", guest_data)
         print("Loading Mapping data into a new dataframe..... ")
-        mapping_df = self.map_data(mapping_data,"")
+        mapping_df = self.map_data(uniques, uids)
         print("Done mapping.")
 
         return (guest_data, mapping_df)
     
-    def map_data(self, mapping_data, method):
+    def map_data(self, values, uids):
         '''
-        Creates a dataframe with unique IDs for each unique PII combination 
+        Creates a dataframe with unique IDs for each unique PII combination. values are
+        the distinct normalized PII strings and uids their hashes
         '''
-    
-        lookup_data = set(map(tuple,mapping_data))  #need to convert the inner lists to tuples so they are hashable
-        #print("Removed Duplicates from Mapping data list....")
-
-        d = list(map(list,lookup_data))
-        #print("Converted back to list....")
-        #print("Converting list of mapping data into a Dataframe....")
-
-        try:
-            data = pd.DataFrame(d)
-            df1 = data.iloc[:,0:13]
-            df1.columns = ["first_name","last_name", "address_1", "address_2","city_code","state_province_code","zip_postal_code", "phone_number", "home_phone_number", "cell_phone_number", "email_address", "internet_address","UID"]
-            df1 = df1[(df1 != df1.columns).all(axis=1)]
-            df1.replace('nan', np.nan, inplace=True)
-            df1.replace('null', np.nan, inplace=True)
-            return df1
-        except:
-            data = pd.DataFrame(d)
-            print(data)
-            print("Error while generating dataframe for mapping data..... ")
-            exit(1)
-
-    def generate_fake_PIIs(self, f):
-        '''Generates fake data in place of original PIIs'''
-    
-        person = Person('en')
-        address = Address('en')
-        generic = Generic('en')
-
-        f.replace('', np.nan, inplace=True)
-        f.replace('nan', np.nan, inplace=True)
-        first_name_replacements = {first_name: "fn_"+person.full_name().split()[0]+"_"+(''.join(random.choice(string.ascii_lowercase + string.digits)for i in range(5))) for first_name in f['first_name'].unique() if first_name is not np.nan}
-        # apply replacement
-        f["first_name"]=f.first_name.map(first_name_replacements)
-        #print("Done replacements for first_name column.....")
-
-        last_name_replacements = {last_name: "ln_"+person.full_name().split()[1]+"_"+(''.join(random.choice(string.ascii_lowercase + string.digits) for i in range(5))) for last_name in f['last_name'].unique() if last_name is not np.nan}
-        f["last_name"]=f.last_name.map(last_name_replacements)
-        #print("Done replacements for last_name column.....")
-
-        address1_replacements = {add1: "a1_"+address.address()+"_"+(''.join(random.choice(string.ascii_lowercase + string.digits) for i in range(5))) for add1 in f['address_1'].unique() if add1 is not np.nan}
-        f["address_1"]=f.address_1.map(address1_replacements)
-        #print("Done replacements for address_1 column.....")
-
-        address2_replacements = {add2: "a2_"+address.address()+"_"+(''.join(random.choice(string.ascii_lowercase + string.digits) for i in range(5))) for add2 in f['address_2'].unique() if add2 is not np.nan}
-        f['address_2']=f.address_2.map(address2_replacements)
-        #print("Done replacements for address_2 column.....")
-
-        phone_replacements = {ph: "ph_"+person.telephone()+"_"+(''.join(random.choice(string.ascii_lowercase + string.digits) for i in range(5))) for ph in f['phone_number'].unique() if ph is not np.nan}
-        f['phone_number'] = f.phone_number.map(phone_replacements)
-        #print("Done replacements for phone_number column.....")
-
-        home_replacements = {hph: "home_"+person.telephone()+"_"+(''.join(random.choice(string.ascii_lowercase + string.digits) for i in range(5)))  for hph in f['home_phone_number'].unique() if hph is not np.nan}
-        f["home_phone_number"]=f.home_phone_number.map(home_replacements)
-        #print("Done replacements for home_phone_number column.....")
-
-        cell_replacements = {cell: "cell_"+person.telephone()+"_"+(''.join(random.choice(string.ascii_lowercase + string.digits) for i in range(5)))  for cell in f['cell_phone_number'].unique() if cell is not np.nan}
-        f["cell_phone_number"]=f.cell_phone_number.map(cell_replacements)
-        #print("Done replacements for cell_phone_number column.....")
-
-        email_replacements = {email: "em_"+person.email()+"_"+(''.join(random.choice(string.ascii_lowercase + string.digits) for i in range(5)))  for email in f['email_address'].unique() if email is not np.nan}
-        f["email_address"]=f.email_address.map(email_replacements)
-        #print("Done replacements for email_address column.....")
-
-        internet_replacements = {internet: "ia_"+person.email()+"_"+(''.join(random.choice(string.ascii_lowercase + string.digits) for i in range(5)))  for internet in f['internet_address'].unique() if internet is not np.nan}
-        f["internet_address"]=f.internet_address.map(internet_replacements)
-        #print("Done replacements for internet_address column.....")
-
-        group_name_replacements = {gname: "group_"+generic.text.word()+"_"+(''.join(random.choice(string.ascii_lowercase + string.digits) for i in range(5)))  for gname in f['group_name'].unique() if gname is not np.nan}
-        f["group_name"]=f.group_name.map(group_name_replacements)
-        #print("Done replacements for group_name column.....")
+        values = pd.Series(values, dtype=object)
+        df1 = values.str.split('$', n=len(PII_COLUMNS)-1, expand=True).reindex(columns=range(len(PII_COLUMNS)))
+        df1.columns = PII_COLUMNS
+        df1['UID'] = uids
+        df1.replace(['nan', 'null'], np.nan, inplace=True)
+        return df1
+
+    def generate_fake_PIIs(self, f, seed = None):
+        '''Generates fake data in place of original PIIs. The same seed gives the same fake data'''
+
+        rng = np.random.default_rng(seed)
+        pools = fake_pools(seed)
+
+        # Every distinct value of a column gets a random fake value and suffix
+        for col, prefix, kind in FAKE_PII:
+            values = f[col].where(~f[col].isin(['', 'nan']))
+            codes, uniques = pd.factorize(values)
+            n = len(uniques)
+            fake = pools[kind][rng.integers(0, FAKE_POOL_SIZE, n)]
+            suffix = SUFFIX_CHARS[rng.integers(0, len(SUFFIX_CHARS), (n, 5))].view('<U5').ravel()
+            tokens = prefix + pd.Series(fake, dtype=object) + '_' + pd.Series(suffix, dtype=object)
+            # Missing values have code -1 and stay missing
+            tokens = np.append(tokens.values.astype(object), np.nan)
+            f[col] = tokens[codes]
 
         return f              
 
-    def execute(self,df,generate_fake = False, message = None):
+    def execute(self,df,generate_fake = False, message = None, seed = None):
         '''
         Execute all the preprocessing pipeline. Returns preprocessed dataframe, rows with errors and invalid data
         '''
@@ -315,7 +322,7 @@ class preprocess:
         # Generate UIDs
         print(f'De-identification: {generate_fake}')
         print('Generating UIDs...')
-        df1, _ = self.generate_UID(df1,generate_fake)
+        df1, _ = self.generate_UID(df1,generate_fake,seed=seed)
 
         # Return preprocessed, errors and invalid data
         return df1, df_err, df_invalid
\ No newline at end of file
@@ -4,10 +4,15 @@
 # UMass
 from geo_amc import GeoOperations
 import pandas as pd
+import numpy as np
 import datetime
 from amcdb import amcdb
 from emissions import ghg_calc
 
+def join_values(values):
+    ''' Text of a column of arrays of values, joined with commas '''
+    return values.map(lambda v: ','.join(str(x) for x in v))
+
 class process:
     def __init__(self, geo ,dbstring):
         '''
@@ -17,36 +22,28 @@ class process:
         self.dbstring = dbstring
 
 
-    def process_geo_distance(self, df, year):
+    def process_geo_distance(self, df, year, mode = 'ellipsoidal'):
         '''
         Create a table with all unique distance pairs (building_code - zip, country). The
-        data will be marked with the year variable for reference in that database
+        data will be marked with the year variable for reference in that database. Mode
+        selects the distance used by the batch computation ('ellipsoidal' or 'haversine')
         '''
-        geo_data_d = self.geo.compute_unique_block_geo_distance(df, year)
-
-        # Create separate fields for point of origin
-        lat = []
-        lon = []
-        for x in geo_data_d.point:
-            if x != None:
-                lat.append(x.latitude)
-                lon.append(x.longitude)
-            else:
-                lat.append(0)
-                lon.append(0)
+        geo_data_d = self.geo.compute_unique_block_geo_distance(df, year, mode)
 
-        # Append separate columns and drop point
-        geo_data_d['lat_p'] = lat
-        geo_data_d['lon_p'] = lon
+        # Origins not found have no coordinates
+        geo_data_d['lat_p'] = geo_data_d['lat_p'].fillna(0)
+        geo_data_d['lon_p'] = geo_data_d['lon_p'].fillna(0)
         geo_data_d = geo_data_d.drop(columns=['point'])
 
         return geo_data_d.reset_index()
 
 
-    def process_drv_distance(self, df, use_api = False, cutoff = 600):
+    def process_drv_distance(self, df, use_api = False, cutoff = 600, concurrency = 1, message = None):
         ''' 
         Process an entire block of data, appending distance to the record
-        If not found use the API to gather the driving distance from Bing or estimate
+        If not found use the API to gather the driving distance from Bing or estimate.
+        Pairs for the API are collected and resolved in batches grouped by building, with
+        up to concurrency requests in flight
         '''
 
         # Compute distance for every pair
@@ -54,6 +51,11 @@ class process:
         d_drv = []
         t_drv = []
         annotate = []
+        pending = []
+        missing = []
+
+        # Load all known pairs at once
+        self.geo.preload_distances(df)
 
         # Iterate over all items in block
         for _, row in df.iterrows():
@@ -65,8 +67,14 @@ class process:
             # Set building code    
             bldg = row['building_code']
             
-            # Lookup for distances
-            dgeo, ddrv, tdrv, loc, _ = self.geo.get_distances(zip1, bldg, use_api, cutoff)
+            # Lookup for distances, new pairs are estimated and marked for the API
+            dgeo, ddrv, tdrv, loc, _ = self.geo.lookup_distances(zip1, bldg)
+            if dgeo == None:
+                dgeo, ddrv, tdrv, loc, _ = self.geo.get_distances(zip1, bldg, False, cutoff, estimate = False)
+                if use_api == True and dgeo != -1 and dgeo < cutoff and loc['point'] != None:
+                    pending.append((len(d_geo), bldg, loc['point'].latitude, loc['point'].longitude))
+                if ddrv == None:
+                    missing.append((len(d_geo), bldg, dgeo, loc['state']))
         
             # Update vector
             d_geo.append(dgeo)
@@ -79,6 +87,30 @@ class process:
                 ann = f"State typo {loc['state']}"
             annotate.append(ann)
 
+        # Estimate all new pairs at once, the API replaces them if used
+        if len(missing) > 0:
+            pos, bldgs, geo, states = zip(*missing)
+            drv, tm = self.geo.estimate_driving_distances(geo, bldgs, states, cutoff)
+            for i, ddrv, tdrv in zip(pos, drv, tm):
+                d_drv[i] = ddrv
+                t_drv[i] = tdrv
+
+        # Resolve all new pairs with the API at once
+        if len(pending) > 0:
+            print(f'Requesting {len(pending)} driving distances...')
+            pairs = pd.DataFrame(pending, columns=['pos','building_code','lat_p','lon_p']).set_index('pos')
+            
+            def progress(done, total):
+                if message != None:
+                    snd = message['send']
+                    jb = message['job']
+                    snd(jb,f"Driving distance requests {done} of {total}...", int(24 + (30-24)*done/total))
+
+            drv = self.geo.compute_driving_distances(pairs, concurrency, progress=progress)
+            for pos, ddrv, tdrv in zip(drv.index, drv['driving_distance'], drv['driving_time']):
+                d_drv[pos] = ddrv
+                t_drv[pos] = tdrv
+
         # Append columns to block
         df['geodesic_distance'] = d_geo
         df['driving_distance'] = d_drv
@@ -90,35 +122,78 @@ class process:
     def reservation_info(self, guest_data):
         '''
         Computing group sizes for each reservation number and information of the origin and destination
-        locations 
+        locations. Buildings, zips, countries and UIDs of a reservation are arrays of their distinct values
         '''
         
         #computing group count by number of bednights
-        group_size_res = guest_data.groupby(['UID','reservation_number','arrival_date','departure_date','Stay_Date'], as_index=False)["NumberofBednights"].agg(sum)
-        group_size_res = group_size_res.groupby(["reservation_number"], as_index=False)["NumberofBednights"].max()
-        group_size_res.columns=["reservation_number","guest_count"]
-        
-        #including destination locations to the group_size_res df
-        guest_data["building_code"].replace({"nan":""})
-        replace_data= guest_data.groupby(["reservation_number"])["building_code"].unique().apply(lambda x: ", ".join(x.astype(str)))
-        group_size_res = (group_size_res.merge(replace_data, left_on='reservation_number', right_on='reservation_number'))
-
-        #including zips and country codes to group_size_res df
-        #    guest_data["zip_postal_code"].replace({"nan":""})
-        replace_data= guest_data.groupby(["reservation_number"])["zip_postal_code"].unique().apply(lambda x: ", ".join(x.astype(str)))
-        group_size_res = (group_size_res.merge(replace_data, left_on='reservation_number', right_on='reservation_number'))
-
-        replace_data= guest_data.groupby(["reservation_number"])["country_code"].unique().apply(lambda x: ", ".join(x.astype(str)))
-        group_size_res = (group_size_res.merge(replace_data, left_on='reservation_number', right_on='reservation_number'))
-        
-        #including UID to group_size_res df
-        replace_data= guest_data.groupby(["reservation_number"])["UID"].unique().apply(lambda x: ", ".join(x.astype(str)))
-        group_size_res = (group_size_res.merge(replace_data, left_on='reservation_number', right_on='reservation_number'))
+        bednights = guest_data.groupby(['UID','reservation_number','arrival_date','departure_date','Stay_Date'])["NumberofBednights"].sum()
 
-        return group_size_res
+        #including destination, origin and UIDs in a single pass
+        group_size_res = guest_data.groupby('reservation_number', sort=True).agg(building_code=('building_code','unique'),
+                                                                                 zip_postal_code=('zip_postal_code','unique'),
+                                                                                 country_code=('country_code','unique'),
+                                                                                 UID=('UID','unique'))
+        group_size_res.insert(0, 'guest_count', bednights.groupby(level='reservation_number').max())
 
-    def visits_info(self, guest_data,group_size_res):
-        
+        return group_size_res.reset_index()
+
+    def club_visits(self, guest_data, mode = 'vectorized'):
+        '''
+        Club the visits of every guest (UID) that are less than 6 days apart. Returns a
+        dataframe with UID, reservation_number and session, with one row per visit and
+        the same session for clubbed visits. mode='loop' runs the reference version club_visits_loop
+        '''
+        if mode == 'loop':
+            visits = self.club_visits_loop(guest_data)
+            visits['session'] = np.arange(visits.shape[0])
+            visits = visits.assign(reservation_number=visits['reservation_number'].str.split(' , ')).explode('reservation_number')
+            visits['reservation_number'] = visits['reservation_number'].astype(guest_data['reservation_number'].dtype)
+            return visits[['UID','reservation_number','session']].reset_index(drop=True)
+
+        # Grouping, sorted by UID, reservation and dates
+        UID_adrb = guest_data.groupby(['UID','reservation_number','arrival_date','departure_date','Stay_Date']).size().reset_index(name="Group_size")
+
+        # Days between the arrival and the previous departure of the same guest
+        new_uid = (UID_adrb['UID'] != UID_adrb['UID'].shift()).values
+        new_res = new_uid | (UID_adrb['reservation_number'] != UID_adrb['reservation_number'].shift()).values
+        days = ((UID_adrb['arrival_date'] - UID_adrb['departure_date'].shift())/datetime.timedelta(days=1)).values
+
+        # First record of every visit. Visits of the same guest less than 6 days apart
+        # are clubbed, a new session starts otherwise
+        visits = UID_adrb.loc[new_res, ['UID','reservation_number']].reset_index(drop=True)
+        days = days[new_res]
+        club = ~new_uid[new_res] & (days == np.round(days)) & (days >= -6) & (days < 6)
+        visits['session'] = np.cumsum(~club)
+
+        return visits
+
+    def visits_info(self, guest_data,group_size_res, mode = 'vectorized'):
+        '''
+        Find the itineraries: the distinct sets of clubbed reservations. Returns a dataframe
+        with one row per itinerary and reservation with itinerary_ID, reservation_number
+        and group_count, the largest guest count of the reservations in the itinerary
+        '''
+        # Clubbed visits of every guest
+        visits = self.club_visits(guest_data, mode)
+
+        # Sessions with the same reservations are the same itinerary
+        sessions = visits.groupby('session', sort=False)['reservation_number'].agg(tuple)
+        itinerary, _ = pd.factorize(sessions)
+        visits['itinerary_ID'] = pd.Series(itinerary, index=sessions.index).reindex(visits['session']).values
+        grouped_visits = visits[['itinerary_ID','reservation_number']].drop_duplicates().reset_index(drop=True)
+
+        # including group count by visits
+        group_count = grouped_visits.merge(group_size_res[['reservation_number','guest_count']], on='reservation_number', how='left')
+        group_count = group_count.groupby('itinerary_ID')['guest_count'].max()
+        grouped_visits['group_count'] = grouped_visits['itinerary_ID'].map(group_count)
+
+        return grouped_visits
+
+    def club_visits_loop(self, guest_data):
+        '''
+        Reference version of club_visits that walks the visits row by row. Kept to test
+        that club_visits gives the same itineraries
+        '''
 
         # Grouping
         UID_adrb = guest_data.groupby(['UID','reservation_number','arrival_date','departure_date','Stay_Date']).size().reset_index(name="Group_size")
@@ -154,7 +229,7 @@ class process:
         UID_adrb_days = UID_adrb.copy()
         UID_adrb_days['days'] = diff_days
         # Included a new field for days apart 
-        visits = UID_adrb_days.groupby(["UID","reservation_number"])["days"].nth(0).reset_index()
+        visits = UID_adrb_days.groupby(["UID","reservation_number"])["days"].first().reset_index()
         
         visits['reservation_number'] = visits.reservation_number.astype(str)
         
@@ -181,54 +256,21 @@ class process:
         rows = visits.index[to_drop_list]
 
         visits.drop(rows, inplace=True)
-    
-        # including group count by visits
-            
-        grouped_visits = visits.groupby(['reservation_number'])['UID'].unique().transform(lambda x: ", ".join(x.astype(str))).reset_index()
-        # grouped_visits = grouped_visits.to_frame()    
 
-        
-        group_size_res["reservation_number"].astype('str')
-        group_count = []
-        for index,row in grouped_visits.iterrows():
-            list_of_group_sizes = []
-            nums = row["reservation_number"].split(",")
-            for each_res in nums:
-                list_of_group_sizes.append(group_size_res.loc[group_size_res["reservation_number"]==int(each_res) , ["guest_count"]].values[0])
-            group_count.append(max(list_of_group_sizes)[0])
-        grouped_visits["group_count"] = group_count
-            
-    
-        # grouped by reservation number and clubbed visits to get total number of visits
-        
-        group2 = grouped_visits.groupby(['reservation_number'])['UID'].unique().transform(lambda x: ", ".join(x.astype(str))).reset_index()
-        
-        # merging to get visits with uid and guest count
-        
-        group3 = grouped_visits.groupby(['reservation_number'])['group_count'].max()
-        group3 = group3.to_frame()
-        grouped_visits=pd.merge(group3, group2, on='reservation_number', how="left")
-        return grouped_visits
+        return visits
 
     def join_on_ItID(self, guest_data, guest_size_res, grouped_visits):
             
-        # adding the column itinerary ID in both files and merging them
-        grouped_visits["itinerary_ID"] = grouped_visits.index
-        grouped_visits_explode=grouped_visits.assign(reservation_number=grouped_visits['reservation_number'].str.split(',')).explode('reservation_number')
-            
-        guest_size_res["reservation_number"] = guest_size_res["reservation_number"].astype(int)
-        grouped_visits_explode["reservation_number"] = grouped_visits_explode["reservation_number"].astype(int)
-        reservation_with_ID = pd.merge(guest_size_res, grouped_visits_explode , on='reservation_number', how="left")
-        # Select colums in reservation_with_ID
-        reservation_with_ID = reservation_with_ID.drop(columns=['UID_y','group_count'])
-        reservation_with_ID = reservation_with_ID.rename(columns={'UID_x':'UID'})
-
-        # reservation_with_ID = reservation_with_ID.drop("Group_count",axis=1)
-        itinerary_df = reservation_with_ID.merge(grouped_visits_explode, left_on='itinerary_ID', right_on='itinerary_ID')       
-        itinerary_df = itinerary_df.groupby('itinerary_ID').agg(lambda x: ','.join(set(x.astype(str)))).reset_index()
-        # select columns in itinerary_df
-        itinerary_df = itinerary_df.drop(columns=['reservation_number_y','group_count','UID_y'])
-        itinerary_df = itinerary_df.rename(columns={'reservation_number_x':'reservation_number','UID_x':'UID'})
+        # adding the column itinerary ID to the reservations
+        reservation_with_ID = pd.merge(guest_size_res, grouped_visits[['reservation_number','itinerary_ID']], on='reservation_number', how="left")
+
+        # One row per itinerary with the reservations, the largest guest count and the distinct
+        # values of all its reservations
+        itn = reservation_with_ID.groupby('itinerary_ID')
+        itinerary_df = itn.agg(reservation_number=('reservation_number','unique'), guest_count=('guest_count','max'))
+        for col in ['building_code','zip_postal_code','country_code','UID']:
+            itinerary_df[col] = reservation_with_ID.set_index('itinerary_ID')[col].explode().groupby(level=0).unique()
+        itinerary_df = itinerary_df.reset_index()
 
         return reservation_with_ID, grouped_visits, itinerary_df
 
@@ -254,127 +296,107 @@ class process:
         return itinerary_df
 
 
-    def update_db(self, itinerary, df1, message = None):
-        ''' 
-        Create the required tables for database and update the database. Return all tables produced
+    def build_tables(self, itinerary, df1, message = None):
         '''
+        Create the itinerary, guest, reservation and building visited tables from the itineraries
+        and the reservations in df1. The reservations are grouped once and the tables are built
+        with grouped operations over all itineraries at once
+        '''
+        if message != None:
+            snd = message['send']
+            jb = message['job']
+            snd(jb,"Creating tables for database...", 52)
 
-        # This are the tables to be created
-        r_tbl = pd.DataFrame(columns=['itinerary_id','reservation'])
-        i_tbl = pd.DataFrame(columns=['itinerary_id','guest_uid','max_group_size','arrival_date','departure_date','in_geo_d','in_drv_d','in_drv_time','out_geo_d','out_drv_d','out_drv_time'])
-        b_visited_tbl = pd.DataFrame(columns=['itinerary_id','building_code','arrival','departure'])
-        g_tbl = pd.DataFrame(columns=['guest_id','zipcode','city','state_province','country'])
-        n_proc = 0
-
-        def upload_database(row, df, itn):
-            '''
-            Process the itineraries with the reservation dataframe to generate all required
-            tables. The function should be applied over the itinerary dataFrame
-            '''
-            nonlocal r_tbl, i_tbl, b_visited_tbl, g_tbl, n_proc, message
-
-            itID = row['itinerary_ID']
-            uid = row['UID']
-            zip_code = row['zip_postal_code']
-            country = row['country_code']
-            #bldg_code = row['building_code'].split(',')
-            grp_size = max(row['guest_count'].split(','))
-            reserv_n = row['reservation_number'].split(',')
-            reserv_n.sort()
-
-            # Process itinerary on buildings
-            case = []
-            for r in reserv_n:
-                case.append(df[df['reservation_number'] == int(r)][['arrival_date','departure_date','building_code','Stay_Date','reservation_number']])
-
-            # Create a single frame for all reservations
-            it = pd.concat(case)
-            bldgs = it.groupby(['building_code','Stay_Date','reservation_number']).min().reset_index().sort_values(by='Stay_Date')
-            
-            # Compute arrival and departure for itinerary
-            arrival_date = it['arrival_date'].min()
-            departure_date = it['departure_date'].max()
-            
-            # Compute arrivals and departure from buildings
-            bldgs['diff']=bldgs.Stay_Date.diff().shift(-1)
-            bldgs['departure_bldg'] = bldgs['Stay_Date'] + bldgs['diff']
-            # Adjust departures
-            comp = bldgs['departure_bldg'] > bldgs['departure_date']
-            bldgs.loc[comp,'departure_bldg'] = bldgs['departure_date']
-            bldgs.iloc[-1,bldgs.columns.get_loc('departure_bldg')] = max(bldgs['departure_date'])
-            res_min = bldgs.groupby(['reservation_number','building_code']).min().reset_index().sort_values(by=['Stay_Date'])
-            res_max = bldgs.groupby(['reservation_number','building_code']).max().reset_index().sort_values(by=['Stay_Date'])
-            
-            bldg_visited_tbl = pd.DataFrame( data = { 'itinerary_id': itID,
-                                                    'building_code': res_min['building_code'],
-                                                    'arrival': res_min['Stay_Date'],
-                                                    'departure': res_max['departure_bldg'] })
-            
-            # Get distances
-            origin = zip_code + ", " + country
+        # Reservations of every itinerary, sorted as text
+        res = itinerary[['itinerary_ID','reservation_number']].explode('reservation_number')
+        res['reservation_number'] = res['reservation_number'].astype(df1['reservation_number'].dtype)
+        res['reservation'] = res['reservation_number'].astype(str)
+        res = res.sort_values(['itinerary_ID','reservation'], kind='mergesort')
+        r_tbl = pd.DataFrame({'itinerary_id': res['itinerary_ID'].values, 'reservation': res['reservation'].values})
+
+        # Stays of every reservation in every building and dates of every reservation
+        stays = df1.groupby(['reservation_number','building_code','Stay_Date'], as_index=False, observed=True)[['arrival_date','departure_date']].min()
+        dates = df1.groupby('reservation_number').agg(arrival_date=('arrival_date','min'), departure_date=('departure_date','max'))
+
+        # Stays of every itinerary in order. The departure from a building is the next stay
+        # or the departure date, whatever comes first, and the last departure of the itinerary
+        bldgs = res[['itinerary_ID','reservation_number']].merge(stays, on='reservation_number')
+        bldgs = bldgs.sort_values(['itinerary_ID','building_code','Stay_Date','reservation_number'])
+        bldgs = bldgs.sort_values(['itinerary_ID','Stay_Date'], kind='mergesort').reset_index(drop=True)
+        itn = bldgs.groupby('itinerary_ID')
+        departure = itn['Stay_Date'].shift(-1)
+        departure = departure.where(~(departure > bldgs['departure_date']), bldgs['departure_date'])
+        last = (bldgs['itinerary_ID'] != bldgs['itinerary_ID'].shift(-1)).values
+        bldgs['departure_bldg'] = departure.where(~last, itn['departure_date'].transform('max'))
+
+        # Visits to buildings ordered by arrival
+        visited = bldgs.groupby(['itinerary_ID','reservation_number','building_code'], as_index=False, observed=True).agg(arrival=('Stay_Date','min'), departure=('departure_bldg','max'))
+        visited = visited.sort_values(['itinerary_ID','arrival'], kind='mergesort')
+        b_visited_tbl = pd.DataFrame({'itinerary_id': visited['itinerary_ID'].values,
+                                      'building_code': visited['building_code'].values,
+                                      'arrival': visited['arrival'].values,
+                                      'departure': visited['departure'].values})
+
+        # Itinerary fields
+        itn = itinerary.set_index('itinerary_ID')
+        ends = visited.groupby('itinerary_ID')['building_code'].agg(['first','last']).reindex(itn.index)
+        span = res[['itinerary_ID','reservation_number']].merge(dates, left_on='reservation_number', right_index=True)
+        span = span.groupby('itinerary_ID').agg(arrival_date=('arrival_date','min'), departure_date=('departure_date','max')).reindex(itn.index)
+        group_type = df1.drop_duplicates('reservation_number').set_index('reservation_number')['group_type_code']
+        group_type_code = group_type.reindex(res.groupby('itinerary_ID')['reservation_number'].first().reindex(itn.index)).replace('nan','')
+
+        # Text of the fields with many values
+        uid, zip_code, country = (join_values(itn[c]) for c in ['UID','zip_postal_code','country_code'])
+
+        # Distances, computed once for every distinct origin and building
+        origin = zip_code + ", " + country
+        pairs = set(zip(origin, ends['first'])) | set(zip(origin, ends['last']))
+        distances = {}
+        for n, (o, b) in enumerate(pairs):
             # Distance calculation use estimation here, because in the pipeline all new addresses should be already 
             # loaded in the lookup table for now
-            in_geo, in_drv, in_time, loc, _ = self.geo.get_distances(origin, bldg_visited_tbl.iloc[0]['building_code'])
-            out_geo, out_drv, out_time, loc, _ = self.geo.get_distances(origin, bldg_visited_tbl.iloc[-1]['building_code'])
-            
-            # Complete data of city and state
-            city = loc['city']
-            state = loc['state']
-            
-            # Create guest table
-            guest_tbl = pd.DataFrame({'guest_id':[uid],
-                                    'zipcode':[zip_code],
-                                    'city':[city],
-                                    'state_province':[state],
-                                    'country':[country]})
-            
-            # Create reservation table
-            reserv_tbl = pd.DataFrame( {'itinerary_id': [itID]*len(reserv_n),'reservation': reserv_n})
-            
-            # Create itinerary
-            group_type_code = df[df.reservation_number == int(reserv_n[0])]['group_type_code'].iloc[0]
-            if group_type_code == 'nan':
-                group_type_code = ''
-            itinerary_tbl = pd.DataFrame( {'itinerary_id': [itID],
-                                        'guest_uid': [uid],
-                                        'max_group_size': [grp_size],
-                                        'arrival_date': [arrival_date],
-                                        'departure_date': [departure_date],
-                                        'in_geo_d': [in_geo],
-                                        'in_drv_d': [in_drv],
-                                        'in_drv_time': [in_time],
-                                        'out_geo_d': [out_geo],
-                                        'out_drv_d': [out_drv],
-                                        'out_drv_time': [out_time],
-                                        'group_type_code': [group_type_code] })
-            
-            # Update globals
-            r_tbl = r_tbl.append(reserv_tbl)
-            i_tbl = i_tbl.append(itinerary_tbl)
-            b_visited_tbl = b_visited_tbl.append(bldg_visited_tbl)
-            g_tbl = g_tbl.append(guest_tbl)
-            n_proc += 1
-            
-            # Print itinerary
-            if n_proc % 1000 == 0:
-                print(f'{n_proc} of {itn}')
-                incr = n_proc/itn
+            distances[(o, b)] = self.geo.get_distances(o, b)
+            if (n + 1) % 1000 == 0:
+                print(f'{n + 1} of {len(pairs)} distances')
                 if message != None:
-                    snd = message['send']
-                    jb = message['job']
-                    snd(jb,f"Processing itinerary {n_proc} of {itn}...", int(52 + (80-52)*incr))
-            
-            return itID
+                    snd(jb,f"Processing distances {n + 1} of {len(pairs)}...", int(52 + (80-52)*(n + 1)/len(pairs)))
+        d_in = [distances[p] for p in zip(origin, ends['first'])]
+        d_out = [distances[p] for p in zip(origin, ends['last'])]
+
+        i_tbl = pd.DataFrame({'itinerary_id': itn.index.values,
+                              'guest_uid': uid.values,
+                              'max_group_size': itn['guest_count'].values,
+                              'arrival_date': span['arrival_date'].values,
+                              'departure_date': span['departure_date'].values,
+                              'in_geo_d': [d[0] for d in d_in],
+                              'in_drv_d': [d[1] for d in d_in],
+                              'in_drv_time': [d[2] for d in d_in],
+                              'out_geo_d': [d[0] for d in d_out],
+                              'out_drv_d': [d[1] for d in d_out],
+                              'out_drv_time': [d[2] for d in d_out],
+                              'group_type_code': group_type_code.values})
+
+        # Complete data of city and state
+        g_tbl = pd.DataFrame({'guest_id': uid.values,
+                              'zipcode': zip_code.values,
+                              'city': [d[3]['city'] for d in d_out],
+                              'state_province': [d[3]['state'] for d in d_out],
+                              'country': country.values})
+
+        return i_tbl, g_tbl, r_tbl, b_visited_tbl
+
+    def update_db(self, itinerary, df1, message = None):
+        ''' 
+        Create the required tables for database and update the database. Return all tables produced.
+        '''
 
         # Find all tables for data
         print('Creating Tables...')
-        
-        if message != None:
-            snd = message['send']
-            jb = message['job']
-            snd(jb,"Creating tables for database...", 52)
-        
-        _ = itinerary.apply(lambda r: upload_database(row=r,df=df1, itn=itinerary.shape[0]), axis=1)
+
+        # Load all distances required by the reservations in one query
+        self.geo.preload_distances(df1)
+        i_tbl, g_tbl, r_tbl, b_visited_tbl = self.build_tables(itinerary, df1, message)
+        print(f'Distance cache: {self.geo.distance_cache.stats()}')
 
         if message != None:
             snd = message['send']
@@ -456,9 +478,10 @@ class process:
         return ghg_tbl
 
 
-    def execute(self, df, year, use_api = False, message = None):
+    def execute(self, df, year, use_api = False, message = None, concurrency = 8):
         '''
-        Execute the whole processing pipeline
+        Execute the whole processing pipeline. Concurrency is the number of API requests
+        in flight when use_api is True
         '''
 
         # If using API update the database with correct new data gathered
@@ -476,7 +499,7 @@ class process:
 
             # Process driving distance
             print('Processing driving distances...')
-            lookup_table_complete = proc.process_drv_distance(lookup_table, use_api)
+            lookup_table_complete = self.process_drv_distance(lookup_table, use_api, concurrency=concurrency, message=message)
             lookup_filtered = lookup_table_complete[~((lookup_table_complete.driving_distance > -1) & (lookup_table_complete.driving_distance < 0))]
             
             if message != None:
@@ -487,8 +510,10 @@ class process:
 
             # Try to update the distance lookup database
             try:
-                amc_db = amcdb(dbstring)
+                amc_db = amcdb(self.dbstring)
                 lookup_filtered.apply(lambda r: amc_db.distance_lookup_insert(r), axis=1) 
+                # Cached pairs are outdated after the update
+                self.geo.distance_cache.clear()
 
                 if message != None:
                     snd = message['send']
@@ -0,0 +1,146 @@
+# Shared read-only geographic tables for AMC workers
+#
+# A parent process loads the zip tables and the AMC buildings once and publishes them
+# as NumPy files in shared memory (/dev/shm). Workers, forked or not, attach to them
+# with memory mapping, so all of them share the same pages instead of holding copies.
+# The Canadian postal table and the AMC buildings are small and loaded by every worker.
+# The buildings are a snapshot taken when the tables are published, changes to the
+# buildings in the database are not seen by jobs until the preload worker is restarted.
+# Start workers with preloading using:
+#   python shared_geo.py <dbstring> [--queue amc-tasks] [--dir /dev/shm/amc_geo]
+# The directory is passed to the jobs in the environment variable AMC_SHARED_DIR
+
+import argparse
+import os
+import shutil
+import sys
+import numpy as np
+import pandas as pd
+from zip_table import ZipTable, PostalTable, register_postal_table
+
+SHARED_DIR = '/dev/shm/amc_geo'
+SHARED_DIR_ENV = 'AMC_SHARED_DIR'
+
+class _CodedStrings:
+    ''' Read-only column of strings kept as integer codes into its distinct values, so
+        the codes can be memory mapped. Code -1 is a missing value and reads as NaN
+    '''
+    def __init__(self, codes, values):
+        self.codes = codes
+        self.values = np.append(np.asarray(values, dtype=object), np.nan)
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def __getitem__(self, i):
+        return self.values[self.codes[i]]
+
+    def __array__(self, dtype = None):
+        return self.values[self.codes] if dtype == None else self.values[self.codes].astype(dtype)
+
+def _save_strings(directory, name, values):
+    ''' Save a column of strings as codes and distinct values, missing values get code -1 '''
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    np.save(os.path.join(directory, f'{name}_codes.npy'), codes.astype(np.int32))
+    np.save(os.path.join(directory, f'{name}_values.npy'), np.asarray(uniques).astype(str))
+
+def _load_strings(directory, name):
+    ''' Memory map a column saved with _save_strings '''
+    return _CodedStrings(np.load(os.path.join(directory, f'{name}_codes.npy'), mmap_mode='r'),
+                         np.load(os.path.join(directory, f'{name}_values.npy')))
+
+def _save_zip_table(table, directory, name):
+    ''' Save the arrays of a ZipTable, state and city as codes so they can be mapped '''
+    np.save(os.path.join(directory, f'{name}_zips.npy'), np.asarray(table.zips))
+    np.save(os.path.join(directory, f'{name}_lat.npy'), np.asarray(table.lat))
+    np.save(os.path.join(directory, f'{name}_lon.npy'), np.asarray(table.lon))
+    _save_strings(directory, f'{name}_state', table.state)
+    _save_strings(directory, f'{name}_city', table.city)
+
+def _load_zip_table(directory, name):
+    ''' Memory map the arrays of a ZipTable saved with _save_zip_table '''
+    arrays = [np.load(os.path.join(directory, f'{name}_{c}.npy'), mmap_mode='r')
+              for c in ('zips','lat','lon')]
+    return ZipTable.from_arrays(*arrays, _load_strings(directory, f'{name}_state'),
+                                _load_strings(directory, f'{name}_city'))
+
+def _save_postal_table(table, directory, name):
+    ''' Save the arrays of a PostalTable. Codes are short strings saved as fixed width '''
+    np.save(os.path.join(directory, f'{name}_codes.npy'), np.asarray(table.codes).astype(str))
+    np.save(os.path.join(directory, f'{name}_lat.npy'), np.asarray(table.lat))
+    np.save(os.path.join(directory, f'{name}_lon.npy'), np.asarray(table.lon))
+    _save_strings(directory, f'{name}_state', table.state)
+    _save_strings(directory, f'{name}_city', table.city)
+
+def _load_postal_table(directory, name):
+    ''' Load a PostalTable saved with _save_postal_table. The table needs a dictionary
+        of its codes in every process, so it is loaded and not mapped (it is small)
+    '''
+    codes, lat, lon = [np.load(os.path.join(directory, f'{name}_{c}.npy')) for c in ('codes','lat','lon')]
+    return PostalTable(codes, lat, lon, np.asarray(_load_strings(directory, f'{name}_state')),
+                       np.asarray(_load_strings(directory, f'{name}_city')))
+
+def publish(geo, directory = SHARED_DIR):
+    ''' Write the read-only tables of a GeoOperations object to directory. The
+        directory is replaced atomically so attached workers never see partial files
+    '''
+    tmp = directory + f'.{os.getpid()}'
+    os.makedirs(tmp, exist_ok=True)
+    _save_zip_table(geo.zip_table, tmp, 'uszip')
+    _save_zip_table(geo.us_postal, tmp, 'uspostal')
+    _save_postal_table(geo.ca_postal, tmp, 'capostal')
+    # The buildings are a few rows of mixed types, they are pickled and not mapped
+    geo.amc_buildings.to_pickle(os.path.join(tmp, 'amc_buildings.pkl'))
+
+    # Swap directories
+    old = directory + '.old'
+    if os.path.isdir(directory):
+        os.rename(directory, old)
+    os.rename(tmp, directory)
+    shutil.rmtree(old, ignore_errors=True)
+
+def shared_dir():
+    ''' Directory of the published tables, AMC_SHARED_DIR or SHARED_DIR if it is not set '''
+    return os.environ.get(SHARED_DIR_ENV, SHARED_DIR)
+
+def attach(directory = SHARED_DIR):
+    ''' Attach to tables published in directory. Registers the postal tables for this
+        process and returns (zip_table, amc_buildings) or None if nothing was published
+    '''
+    if not os.path.isfile(os.path.join(directory, 'amc_buildings.pkl')):
+        print(f'Warning: No shared geographic tables in {directory}, they are loaded by this process', file=sys.stderr)
+        return None
+    try:
+        zip_table = _load_zip_table(directory, 'uszip')
+        register_postal_table('us', _load_zip_table(directory, 'uspostal'))
+        register_postal_table('ca', _load_postal_table(directory, 'capostal'))
+        amc_buildings = pd.read_pickle(os.path.join(directory, 'amc_buildings.pkl'))
+    except (IOError, ValueError) as e:
+        print(f'Error: Could not attach to shared geographic tables: {e}', file=sys.stderr)
+        return None
+    return zip_table, amc_buildings
+
+if __name__ == '__main__':
+    from redis import Redis
+    from rq import Connection, Worker
+    from geo_amc import GeoOperations
+
+    parser = argparse.ArgumentParser(description='Preload geographic tables and start an RQ worker')
+    parser.add_argument('dbstring')
+    parser.add_argument('--zipfile', default='us-zip-code-latitude-and-longitude.csv')
+    parser.add_argument('--queue', default='amc-tasks')
+    parser.add_argument('--dir', default=shared_dir())
+    args = parser.parse_args()
+    # Jobs inherit the environment of the worker
+    os.environ[SHARED_DIR_ENV] = args.dir
+
+    # Load everything once in the parent and publish it
+    geo = GeoOperations(uszipfile=args.zipfile, key='', dbstring=args.dbstring)
+    publish(geo, args.dir)
+    print(f'Geographic tables published in {args.dir}')
+    del geo
+    # Jobs are forked from this process and attach to the published tables
+    attach(args.dir)
+
+    with Connection(Redis()):
+        Worker([args.queue]).work()
@@ -0,0 +1,57 @@
+# Spatial index over points on the earth for AMC
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+EARTH_RADIUS_MI = 3958.7613  # Mean earth radius in miles
+
+def to_unit_sphere(lat, lon):
+    ''' Cartesian coordinates on the unit sphere of arrays of lat, lon in degrees '''
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lon = np.radians(np.asarray(lon, dtype=float))
+    return np.stack([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)], axis=-1)
+
+class SpatialIndex:
+    ''' KD-tree over points on the unit sphere. Answers nearest neighbour and radius
+        queries for batches of points, distances are great circle miles
+    '''
+    def __init__(self, lat, lon):
+        self.lat = np.asarray(lat, dtype=float)
+        self.lon = np.asarray(lon, dtype=float)
+        self.tree = cKDTree(to_unit_sphere(self.lat, self.lon))
+
+    def __len__(self):
+        return self.lat.shape[0]
+
+    def nearest(self, lat, lon, k = 1):
+        ''' Return (distance in miles, row) of the k nearest points of every query point.
+            Query points with NaN coordinates get distance inf and row len(self)
+        '''
+        xyz = to_unit_sphere(lat, lon)
+        valid = ~np.isnan(xyz).any(axis=-1)
+        chord, idx = self.tree.query(np.where(valid[..., None], xyz, 0), k=k)
+        dist = 2*EARTH_RADIUS_MI*np.arcsin(np.clip(chord/2, 0, 1))
+        if k > 1:
+            valid = valid[..., None]
+        return np.where(valid, dist, np.inf), np.where(valid, idx, len(self))
+
+    def within(self, lat, lon, radius):
+        ''' Return the rows of all points within radius miles of every query point. For
+            a single (scalar) query point the list of its rows is returned
+        '''
+        chord = 2*np.sin(min(radius/EARTH_RADIUS_MI, np.pi)/2)
+        rows = self.tree.query_ball_point(to_unit_sphere(np.atleast_1d(lat), np.atleast_1d(lon)), chord)
+        if np.ndim(lat) == 0 and np.ndim(lon) == 0:
+            return rows[0]
+        return list(rows)
+
+def zip3_centroids(zip_table):
+    ''' Centroid (lat, lon) of the zip codes of every 3 digit zip area, as a dataframe
+        indexed by the zip3 number
+    '''
+    xyz = pd.DataFrame(to_unit_sphere(zip_table.lat, zip_table.lon), columns=['x','y','z'])
+    xyz['zip3'] = zip_table.zips//100
+    c = xyz.groupby('zip3')[['x','y','z']].mean()
+    return pd.DataFrame({'lat': np.degrees(np.arctan2(c['z'], np.hypot(c['x'], c['y']))),
+                         'lon': np.degrees(np.arctan2(c['y'], c['x']))}, index=c.index)
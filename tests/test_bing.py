@@ -0,0 +1,84 @@
+# Tests for the Bing DistanceMatrix client for AMC, run against the local stub
+
+import os
+import sys
+import random
+import time
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from bing import BingDistanceMatrix
+from bing_stub import BingStubHandler, start_stub
+from geo_amc import haversine_distance
+
+@pytest.fixture
+def stub(request):
+    '''
+    Stub server with the fail rate and latency given by the test (indirect parameters)
+    '''
+    params = getattr(request, 'param', {})
+    server, url = start_stub(**params)
+    yield server, url
+    server.shutdown()
+    server.server_close()
+
+def pending_pairs(n = 20, seed = 0):
+    '''
+    Pending pairs of two buildings interleaved, so the client has to regroup them
+    '''
+    rng = np.random.default_rng(seed)
+    bldg = np.where(np.arange(n) % 2 == 0, 'hl', 'jp')
+    return pd.DataFrame({'building_code': bldg,
+                         'lat_p': rng.uniform(40, 45, n),
+                         'lon_p': rng.uniform(-75, -70, n),
+                         'lat': np.where(bldg == 'hl', 44.26, 44.15),
+                         'lon': np.where(bldg == 'hl', -71.25, -71.35)}, index=rng.permutation(n))
+
+def expected_miles(pairs):
+    '''
+    Driving distance in miles answered by the stub for every pair
+    '''
+    return haversine_distance(pairs['lat_p'].values, pairs['lon_p'].values,
+                              pairs['lat'].values, pairs['lon'].values)*BingStubHandler.road_factor
+
+@pytest.mark.parametrize('concurrent', [False, True])
+def test_results_in_input_order(stub, concurrent):
+    _, url = stub
+    client = BingDistanceMatrix('key', url=url, max_batch=3, rate_limit=None)
+    pairs = pending_pairs()
+    out = client.resolve_concurrent(pairs, max_in_flight=4) if concurrent else client.resolve(pairs)
+    assert list(out.index) == list(pairs.index)
+    assert np.allclose(out['driving_distance'].values, expected_miles(pairs))
+    assert (out['driving_time'] > 0).all()
+
+@pytest.mark.parametrize('stub', [{'fail_rate': 0.5}], indirect=True)
+def test_retry_on_throttling(stub):
+    server, url = stub
+    random.seed(0)
+    client = BingDistanceMatrix('key', url=url, max_batch=3, retries=10, backoff=0, rate_limit=None)
+    pairs = pending_pairs()
+    out = client.resolve(pairs)
+    counts = server.RequestHandlerClass.counts
+    assert counts['failures'] > 0
+    assert client.failures == 0
+    assert np.allclose(out['driving_distance'].values, expected_miles(pairs))
+
+@pytest.mark.parametrize('stub', [{'fail_rate': 1.0}], indirect=True)
+def test_failed_requests_are_marked(stub):
+    _, url = stub
+    client = BingDistanceMatrix('key', url=url, max_batch=5, retries=1, backoff=0, rate_limit=None)
+    out = client.resolve(pending_pairs())
+    assert (out['driving_distance'] == -1).all()
+    assert client.failures == 4
+
+@pytest.mark.parametrize('stub', [{'latency': 1.0}], indirect=True)
+def test_timeout(stub):
+    _, url = stub
+    client = BingDistanceMatrix('key', url=url, max_batch=10, retries=0, rate_limit=None)
+    start = time.monotonic()
+    out = client.resolve_concurrent(pending_pairs(), max_in_flight=2, timeout=0.2)
+    assert time.monotonic() - start < 1.0
+    assert (out['driving_distance'] == -1).all()
+    assert client.failures == 2
@@ -0,0 +1,59 @@
+# Tests for the persistent geocode cache for AMC, run offline with StaticResolver
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from geocode_cache import GeocodeCache, StaticResolver
+
+class CountingResolver(StaticResolver):
+    '''
+    StaticResolver that counts its lookups and can be made to fail like the network
+    '''
+    def __init__(self, places, fail = False):
+        StaticResolver.__init__(self, places)
+        self.calls = 0
+        self.fail = fail
+
+    def geocode(self, query):
+        self.calls += 1
+        if self.fail:
+            raise IOError('network down')
+        return StaticResolver.geocode(self, query)
+
+PLACES = {'France': (46.6, 1.9), 'Japan': (36.6, 138.2)}
+
+def test_places_are_resolved_once_and_persisted(tmp_path):
+    path = str(tmp_path / 'geocode.sqlite')
+    resolver = CountingResolver(PLACES)
+    cache = GeocodeCache(path, resolver)
+    assert cache.get('france') == (46.6, 1.9)
+    assert cache.get(' FRANCE, ') == (46.6, 1.9)
+    assert resolver.calls == 1
+
+    # A new process reads the file and does not use the network
+    offline = CountingResolver({}, fail=True)
+    assert GeocodeCache(path, offline).get('France') == (46.6, 1.9)
+    assert offline.calls == 0
+
+def test_places_not_found_are_stored(tmp_path):
+    path = str(tmp_path / 'geocode.sqlite')
+    resolver = CountingResolver(PLACES)
+    assert GeocodeCache(path, resolver).get('Atlantis') == None
+    assert GeocodeCache(path, resolver).get('Atlantis') == None
+    assert resolver.calls == 1
+
+def test_resolver_errors_are_retried():
+    resolver = CountingResolver(PLACES, fail=True)
+    cache = GeocodeCache(':memory:', resolver)
+    assert cache.get('Japan') == None
+    resolver.fail = False
+    assert cache.get('Japan') == (36.6, 138.2)
+    assert resolver.calls == 2
+
+def test_warm():
+    resolver = CountingResolver(PLACES)
+    cache = GeocodeCache(':memory:', resolver)
+    assert cache.warm(['France', 'Japan', 'France']) == 2
+    cache.get('Japan')
+    assert resolver.calls == 2
@@ -0,0 +1,40 @@
+# Tests for the preprocess pipeline for AMC
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('mimesis')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from preprocess import preprocess, FAKE_PII
+
+def guest_pii(n = 200, seed = 0):
+    '''
+    PII columns with repeated values and missing values ('' and NaN)
+    '''
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({col: rng.choice([f'{col}_{i}' for i in range(10)] + ['', np.nan], n).astype(object)
+                       for col, _, _ in FAKE_PII})
+    return df.replace('nan', np.nan)
+
+def test_fake_piis_same_seed():
+    pp = preprocess(None)
+    df = guest_pii()
+    a = pp.generate_fake_PIIs(df.copy(), seed=7)
+    b = pp.generate_fake_PIIs(df.copy(), seed=7)
+    c = pp.generate_fake_PIIs(df.copy(), seed=8)
+    pd.testing.assert_frame_equal(a, b)
+    assert not a.equals(c)
+
+def test_fake_piis_consistent():
+    pp = preprocess(None)
+    df = guest_pii()
+    fake = pp.generate_fake_PIIs(df.copy(), seed=7)
+    for col, prefix, _ in FAKE_PII:
+        missing = df[col].isnull() | (df[col] == '')
+        assert fake.loc[missing, col].isnull().all()
+        assert fake.loc[~missing, col].str.startswith(prefix).all()
+        # Same original value, same fake value
+        assert (fake[~missing].groupby(df.loc[~missing, col])[col].nunique() == 1).all()
@@ -0,0 +1,43 @@
+# Tests for the processing pipeline for AMC
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from process import process
+
+def guest_data(n = 600, guests = 40, seed = 0):
+    '''
+    Fixed seed reservations. Every reservation belongs to one guest and has one to three
+    stay dates, arrivals are close enough for many visits of a guest to be clubbed
+    '''
+    rng = np.random.default_rng(seed)
+    res = np.arange(n)
+    uid = rng.integers(0, guests, n).astype(str)
+    arrival = pd.Timestamp('2019-01-01') + pd.to_timedelta(rng.integers(0, 120, n), unit='D')
+    departure = arrival + pd.to_timedelta(rng.integers(1, 4, n), unit='D')
+    nights = rng.integers(1, 4, n)
+    rows = np.repeat(np.arange(n), nights)
+    stay = arrival[rows] + pd.to_timedelta(np.concatenate([np.arange(k) for k in nights]), unit='D')
+    return pd.DataFrame({'UID': uid[rows],
+                         'reservation_number': res[rows],
+                         'arrival_date': arrival[rows],
+                         'departure_date': departure[rows],
+                         'Stay_Date': stay})
+
+def membership(visits):
+    '''
+    Sorted (UID, reservations) of every session, independent of the session numbers
+    '''
+    sessions = visits.groupby('session')
+    return sorted(zip(sessions['UID'].first(), sessions['reservation_number'].agg(lambda r: tuple(sorted(r)))))
+
+def test_club_visits_modes_match():
+    pr = process(None, None)
+    df = guest_data()
+    loop = pr.club_visits(df, mode='loop')
+    vectorized = pr.club_visits(df, mode='vectorized')
+    assert loop.shape[0] == vectorized.shape[0]
+    assert membership(loop) == membership(vectorized)
@@ -0,0 +1,51 @@
+# Tests for the spatial index for AMC, checked against brute force haversine distances
+
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from spatial_index import SpatialIndex
+from geo_amc import haversine_distance
+
+rng = np.random.default_rng(0)
+LAT = rng.uniform(25, 49, 500)
+LON = rng.uniform(-125, -67, 500)
+QLAT = rng.uniform(25, 49, 50)
+QLON = rng.uniform(-125, -67, 50)
+
+def brute_distances(lat, lon):
+    '''
+    Haversine miles from a query point to every indexed point
+    '''
+    return haversine_distance(np.full(LAT.shape, lat), np.full(LON.shape, lon), LAT, LON)
+
+def test_nearest():
+    index = SpatialIndex(LAT, LON)
+    dist, idx = index.nearest(QLAT, QLON, k=3)
+    for q in range(QLAT.shape[0]):
+        d = brute_distances(QLAT[q], QLON[q])
+        assert list(idx[q]) == list(np.argsort(d)[:3])
+        assert np.allclose(dist[q], np.sort(d)[:3], rtol=1e-3)
+
+def test_nearest_missing_point():
+    index = SpatialIndex(LAT, LON)
+    dist, idx = index.nearest(np.array([np.nan, QLAT[0]]), np.array([np.nan, QLON[0]]))
+    assert dist[0] == np.inf and idx[0] == len(index)
+    assert idx[1] == np.argmin(brute_distances(QLAT[0], QLON[0]))
+
+def test_within():
+    index = SpatialIndex(LAT, LON)
+    rows = index.within(QLAT, QLON, 150)
+    assert len(rows) == QLAT.shape[0]
+    for q in range(QLAT.shape[0]):
+        d = brute_distances(QLAT[q], QLON[q])
+        # Points right at the radius may fall on either side
+        inside = set(np.flatnonzero(d < 149.9))
+        assert inside <= set(rows[q]) <= set(np.flatnonzero(d < 150.1))
+
+def test_within_scalar():
+    index = SpatialIndex(LAT, LON)
+    rows = index.within(QLAT[0], QLON[0], 300)
+    assert sorted(rows) == sorted(index.within(QLAT[:1], QLON[:1], 300)[0])
+    assert all(isinstance(r, (int, np.integer)) for r in rows)
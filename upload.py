@@ -2,6 +2,7 @@
 # Test of RQ for task
 
 import time
+from os.path import isfile
 from rq import get_current_job
 from rq.decorators import job
 
@@ -11,6 +12,7 @@ import pandas as pd
 from preprocess import preprocess
 from process import process
 from geo_amc import GeoOperations
+from shared_geo import shared_dir
 from emissions import parameters
 
 emission_data = [{'name': 'ghg30',
@@ -65,7 +67,10 @@ def upload_and_process(dbstring, apikey, year, data):
         job.save_meta()
 
         # Intialize geo operations object
-        geo = GeoOperations(uszipfile='us-zip-code-latitude-and-longitude.csv',key=apikey,dbstring = dbstring)
+        dmatrix = 'distance_matrix' if isfile('distance_matrix.npy') else None
+        drv_model = 'drv_model.json' if isfile('drv_model.json') else None
+        geo = GeoOperations(uszipfile='us-zip-code-latitude-and-longitude.csv',key=apikey,dbstring = dbstring, 
+                            distance_matrix = dmatrix, drv_model = drv_model, shared_dir = shared_dir())
         pp = preprocess(geo)
         pr = process(geo,dbstring)
         
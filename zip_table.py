@@ -0,0 +1,228 @@
+# In-memory zip code table for AMC
+
+import pandas as pd
+import numpy as np
+import sys
+import os
+import hashlib
+import tempfile
+import zipfile
+import pgeocode
+
+# Postal tables from pgeocode loaded once per process
+_postal_tables = {}
+
+def _file_hash(filename):
+    ''' SHA-1 of the content of a file '''
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _rows_frame(table, idx, index = None):
+    ''' Dataframe with lat, lon, state and city of the rows idx of a table (-1 not found) '''
+    if len(table) == 0:
+        idx = np.full(idx.shape[0], -1, dtype=np.int64)
+    found = idx != -1
+    safe = np.where(found, idx, 0)
+    def take(col, missing):
+        if len(table) == 0:
+            return np.full(idx.shape[0], missing, dtype=object if missing == None else float)
+        return np.where(found, col[safe], missing)
+    return pd.DataFrame({'lat': take(table.lat, np.nan),
+                         'lon': take(table.lon, np.nan),
+                         'state': take(table.state, None),
+                         'city': take(table.city, None)}, index=index)
+
+class ZipTable:
+    ''' Compact table of US zip codes indexed by zip. Zip codes are kept as a sorted
+        integer array and coordinates, state and city as parallel arrays, so a lookup
+        is a binary search (searchsorted) instead of a scan over a dataframe
+    '''
+    def __init__(self, zips, lat, lon, state, city):
+        ''' Build the table from parallel arrays. Arrays are sorted by zip here '''
+        zips = np.asarray(zips, dtype=np.int64)
+        order = np.argsort(zips, kind='mergesort')
+        self.zips = zips[order]
+        self.lat = np.asarray(lat, dtype=np.float64)[order]
+        self.lon = np.asarray(lon, dtype=np.float64)[order]
+        self.state = np.asarray(state, dtype=object)[order]
+        self.city = np.asarray(city, dtype=object)[order]
+
+    @classmethod
+    def from_arrays(cls, zips, lat, lon, state, city):
+        ''' Wrap arrays already sorted by zip without copying them (e.g. memory mapped) '''
+        table = cls.__new__(cls)
+        table.zips, table.lat, table.lon, table.state, table.city = zips, lat, lon, state, city
+        return table
+
+    @classmethod
+    def from_csv(cls, filename, sep = ';'):
+        ''' Load the table from the US zip code csv file (Zip, City, State, Latitude, Longitude) '''
+        df = pd.read_csv(filename, sep=sep, usecols=['Zip','City','State','Latitude','Longitude'])
+        return cls(df['Zip'].values, df['Latitude'].values, df['Longitude'].values,
+                   df['State'].values, df['City'].values)
+
+    @classmethod
+    def from_cache(cls, filename, sep = ';', cache = None):
+        ''' Load the table from a binary (npz) cache of the csv file. The cache (by default
+            filename.npz) is rebuilt when the modification time and the hash of the csv
+            do not match the ones stored in it
+        '''
+        cache = filename + '.npz' if cache == None else cache
+        mtime = os.path.getmtime(filename)
+        sha1 = None
+        try:
+            with np.load(cache) as npz:
+                if npz['mtime'] == mtime:
+                    return cls(npz['zips'], npz['lat'], npz['lon'], npz['state'], npz['city'])
+                sha1 = _file_hash(filename)
+                if npz['sha1'] == sha1:
+                    # Same content with a new modification time, the cache is rewritten
+                    # with the new time so the csv is not hashed again on every start
+                    table = cls(npz['zips'], npz['lat'], npz['lon'], npz['state'], npz['city'])
+                    table.save_cache(cache, mtime, sha1)
+                    return table
+        except (IOError, KeyError, ValueError, zipfile.BadZipFile):
+            pass
+
+        # Cache missing, corrupt or outdated
+        table = cls.from_csv(filename, sep=sep)
+        table.save_cache(cache, mtime, _file_hash(filename) if sha1 == None else sha1)
+        return table
+
+    def save_cache(self, cache, mtime, sha1):
+        ''' Write the table to the npz file cache. The file is written to a temporary file in
+            the same directory and moved in place, so a reader never sees a partial cache
+        '''
+        tmp = None
+        try:
+            fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(cache)))
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, zips=self.zips, lat=self.lat, lon=self.lon,
+                         state=self.state.astype(str), city=self.city.astype(str),
+                         mtime=mtime, sha1=sha1)
+            os.replace(tmp, cache)
+        except (IOError, OSError):
+            print(f'Error: Could not write zip code cache {cache}', file=sys.stderr)
+            if tmp != None and os.path.exists(tmp):
+                os.remove(tmp)
+
+    @classmethod
+    def from_pgeocode(cls, country = 'us'):
+        ''' Load the table from the pgeocode (GeoNames) dataset of a country with numeric codes '''
+        df = pgeocode.Nominatim(country)._data_frame
+        df = df[pd.to_numeric(df['postal_code'], errors='coerce').notnull()]
+        return cls(df['postal_code'].astype(int).values, df['latitude'].values, df['longitude'].values,
+                   df['state_code'].values, df['place_name'].values)
+
+    def __len__(self):
+        return self.zips.shape[0]
+
+    def index(self, zipc):
+        ''' Return the row of zip code zipc in the table or -1 if not found '''
+        try:
+            zipc = int(zipc)
+        except (TypeError, ValueError):
+            return -1
+        i = int(np.searchsorted(self.zips, zipc))
+        if i < self.zips.shape[0] and self.zips[i] == zipc:
+            return i
+        return -1
+
+    def lookup(self, zipc):
+        ''' Return (lat, lon, state, city) for a zip code or None if not found '''
+        i = self.index(zipc)
+        if i == -1:
+            return None
+        return (self.lat[i], self.lon[i], self.state[i], self.city[i])
+
+    def index_zips(self, zips):
+        ''' Vectorized version of index. Return an array with the rows of all zips
+            (-1 when not found). Zips can be integers or strings
+        '''
+        zips = pd.to_numeric(pd.Series(zips), errors='coerce').values
+        if len(self) == 0:
+            return np.full(zips.shape[0], -1, dtype=np.int64)
+        valid = ~np.isnan(zips)
+        keys = np.where(valid, zips, -1).astype(np.int64)
+        idx = np.searchsorted(self.zips, keys)
+        idx = np.minimum(idx, max(self.zips.shape[0] - 1, 0))
+        found = valid & (self.zips[idx] == keys)
+        return np.where(found, idx, -1)
+
+    def lookup_zips(self, zips):
+        ''' Resolve a whole column of zip codes in one call. Returns a dataframe aligned
+            with the input with columns lat, lon, state and city (NaN/None if not found)
+        '''
+        idx = self.index_zips(zips)
+        index = zips.index if isinstance(zips, pd.Series) else None
+        return _rows_frame(self, idx, index)
+
+class PostalTable:
+    ''' Alphanumeric postal codes (e.g. Canadian FSA) indexed in a dictionary to the row
+        of parallel arrays with coordinates, state and city
+    '''
+    def __init__(self, codes, lat, lon, state, city):
+        ''' Build the table from parallel arrays, codes are normalized to upper case '''
+        self.codes = np.array([str(c).strip().upper() for c in codes], dtype=object)
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.state = np.asarray(state, dtype=object)
+        self.city = np.asarray(city, dtype=object)
+        self.rows = {c: i for i, c in enumerate(self.codes)}
+
+    @classmethod
+    def from_pgeocode(cls, country = 'ca'):
+        ''' Load the table from the pgeocode (GeoNames) dataset of a country. Rows without
+            coordinates are dropped
+        '''
+        df = pgeocode.Nominatim(country)._data_frame
+        df = df.dropna(subset=['latitude','longitude'])
+        return cls(df['postal_code'].values, df['latitude'].values, df['longitude'].values,
+                   df['state_code'].values, df['place_name'].values)
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def index(self, code):
+        ''' Return the row of a postal code in the table or -1 if not found '''
+        if code == None:
+            return -1
+        return self.rows.get(str(code).strip().upper(), -1)
+
+    def lookup(self, code):
+        ''' Return (lat, lon, state, city) for a postal code or None if not found '''
+        i = self.index(code)
+        if i == -1:
+            return None
+        return (self.lat[i], self.lon[i], self.state[i], self.city[i])
+
+    def lookup_codes(self, codes):
+        ''' Resolve a whole column of postal codes in one call. Returns a dataframe aligned
+            with the input with columns lat, lon, state and city (NaN/None if not found)
+        '''
+        codes = pd.Series(codes)
+        idx = np.array([self.index(c) for c in codes], dtype=np.int64)
+        return _rows_frame(self, idx, codes.index)
+
+def load_postal_table(country):
+    ''' Return the postal table of a country from pgeocode ('us' as a ZipTable, any other
+        as a PostalTable). Tables are loaded once per process and shared by all users. If
+        the dataset can not be loaded the error is raised and nothing is stored, so the
+        next call tries again
+    '''
+    country = country.lower()
+    if country not in _postal_tables:
+        table_cls = ZipTable if country == 'us' else PostalTable
+        try:
+            _postal_tables[country] = table_cls.from_pgeocode(country)
+        except Exception as e:
+            print(f'Error: Could not load postal codes for {country}: {e}', file=sys.stderr)
+            raise
+    return _postal_tables[country]
+
+def register_postal_table(country, table):
+    ''' Use table as the postal table of a country in this process (e.g. shared tables) '''
+    _postal_tables[country.lower()] = table